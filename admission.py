@@ -0,0 +1,134 @@
+"""准入控制与降载
+
+按路由把请求划分为不同的并发等级（借还、浏览、统计分析），每个等级有独立的并发上限、
+有界等待队列和数据库查询超时。队列已满或等待超时的请求直接返回 503 + Retry-After，
+避免统计报表占满工作线程和数据库连接，拖慢前台借书、还书。
+"""
+
+import threading
+import time
+
+from flask import g, has_request_context, jsonify, request
+
+
+class AdmissionClass:
+    """一个并发等级：并发上限 + 有界等待队列"""
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout, query_timeout, retry_after):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout    # 排队最长等待秒数
+        self.query_timeout = query_timeout    # 该等级数据库查询超时秒数，0 表示不限制
+        self.retry_after = retry_after        # 503 响应中的 Retry-After 秒数
+
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """申请执行名额，成功返回 True，被拒绝返回 False"""
+        start = time.monotonic()
+        with self._cond:
+            if self.active < self.max_concurrent and self.waiting == 0:
+                self.active += 1
+                self.admitted += 1
+                return True
+
+            if self.waiting >= self.max_queue:
+                self.rejected_queue_full += 1
+                return False
+
+            self.waiting += 1
+            deadline = start + self.queue_timeout
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_timeout += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            waited = time.monotonic() - start
+            self.active += 1
+            self.admitted += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            return True
+
+    def release(self):
+        """归还执行名额并唤醒一个排队请求"""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'queue_depth': self.waiting,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+                'avg_wait_ms': round(self.total_wait * 1000 / self.admitted, 2) if self.admitted else 0,
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+                'query_timeout': self.query_timeout,
+            }
+
+
+class AdmissionController:
+    """根据 Flask endpoint 选择并发等级，在请求前后申请/归还名额"""
+
+    def __init__(self, classes, route_classes):
+        self.classes = {cls.name: cls for cls in classes}
+        self.route_classes = route_classes
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def class_for(self, endpoint):
+        name = self.route_classes.get(endpoint)
+        return self.classes.get(name) if name else None
+
+    def current_class(self):
+        """当前请求所属的并发等级，未分级或不在请求上下文中返回 None"""
+        if not has_request_context():
+            return None
+        return g.get('admission_class')
+
+    def query_timeout(self):
+        """当前请求应使用的数据库查询超时秒数"""
+        cls = self.current_class()
+        return cls.query_timeout if cls else 0
+
+    def stats(self):
+        return {name: cls.stats() for name, cls in self.classes.items()}
+
+    def _before_request(self):
+        cls = self.class_for(request.endpoint)
+        if cls is None:
+            return None
+
+        if not cls.acquire():
+            response = jsonify({'success': False, 'message': '系统繁忙，请稍后重试'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(cls.retry_after)
+            return response
+
+        g.admission_class = cls
+        return None
+
+    def _teardown_request(self, exc):
+        cls = g.pop('admission_class', None)
+        if cls is not None:
+            cls.release()
@@ -0,0 +1,501 @@
+"""列式分析快照
+
+将 borrow / book / reader / category 导出为紧凑的列文件（NumPy 类型数组 + 字符串字典），
+统计接口通过内存映射读取快照并使用向量化运算完成聚合，不再在在线库上执行多表 GROUP BY。
+
+目录结构：
+    <snapshot_dir>/CURRENT            当前生效的快照代号
+    <snapshot_dir>/gen-000001/        每一代快照一个目录
+        meta.json                     元数据（last_borrow_id、导出时间、行数）
+        strings.json                  字符串字典
+        borrow.book_id.npy ...        每列一个 .npy 文件
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import date, datetime
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows 开发环境只跑单进程，不需要跨进程锁
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+NULL_ID = -1      # 整数列中的 NULL
+NULL_DATE = 0     # 日期列按 ordinal 存储，0 表示 NULL
+NULL_STRING = -1  # 字符串列中的 NULL
+FETCH_SIZE = 10000
+CHECK_INTERVAL = 1.0  # 两次检查 CURRENT 是否切换的最短间隔（秒）
+# 增量刷新时回看 last_borrow_id 之下多少个 ID：自增 ID 在插入时分配、提交后才可见，
+# 较小 ID 的借阅可能晚于较大 ID 提交，上次导出时还看不到
+LATE_WINDOW = 10000
+
+# 每张表导出的列：(列名, 类型)，类型 'str' 表示写入字符串字典后存储编码
+TABLES = {
+    'category': [('category_id', 'id'), ('category_name', 'str')],
+    'book': [('book_id', 'id'), ('book_name', 'str'), ('author', 'str'),
+             ('category_id', 'id'), ('total_count', 'int'), ('available_count', 'int')],
+    'reader': [('reader_id', 'id'), ('name', 'str'), ('gender', 'str')],
+    'borrow': [('borrow_id', 'id'), ('reader_id', 'id'), ('book_id', 'id'),
+               ('borrow_date', 'date'), ('actual_return_date', 'date')],
+}
+
+
+def _lookup(sorted_keys, values):
+    """在有序主键数组中定位 values，返回 (下标, 是否命中)"""
+    if len(sorted_keys) == 0:
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    pos = np.searchsorted(sorted_keys, values)
+    pos = np.minimum(pos, len(sorted_keys) - 1)
+    return pos, sorted_keys[pos] == values
+
+
+def _exported_ts(meta):
+    """快照导出时间戳"""
+    return datetime.fromisoformat(meta['exported_at']).timestamp()
+
+
+def _to_date(ordinal):
+    """ordinal 转日期，NULL 返回 None"""
+    ordinal = int(ordinal)
+    return date.fromordinal(ordinal) if ordinal != NULL_DATE else None
+
+
+class StringDictionary:
+    """字符串字典：字符串 <-> int32 编码"""
+
+    def __init__(self, values=None):
+        self.values = list(values or [])
+        self._codes = {value: code for code, value in enumerate(self.values)}
+
+    def encode(self, value):
+        if value is None:
+            return NULL_STRING
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._codes[value] = code
+        return code
+
+    def decode(self, code):
+        code = int(code)
+        return self.values[code] if code != NULL_STRING else None
+
+
+class SnapshotExporter:
+    """快照导出器：全量导出或基于 last_borrow_id 的增量刷新"""
+
+    def __init__(self, snapshot_dir, connect, keep_generations=2):
+        self.snapshot_dir = snapshot_dir
+        self.connect = connect
+        self.keep_generations = keep_generations
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self, full=False):
+        """刷新快照，返回新的元数据"""
+        with self._lock, _FileLock(self.snapshot_dir):
+            return self._refresh(full)
+
+    def refresh_if_stale(self, interval, full_interval=None):
+        """快照超过 interval 秒未刷新时增量刷新，距上次全量导出超过 full_interval 秒时全量导出；
+        其他进程正在刷新时直接跳过，返回 None"""
+        with self._lock, _FileLock(self.snapshot_dir, blocking=False) as locked:
+            if not locked:
+                return None
+            current = read_current(self.snapshot_dir)
+            if current is not None and time.time() - _exported_ts(current[1]) < interval:
+                return None
+            full = (current is not None and full_interval is not None
+                    and time.time() - current[1].get('full_exported_ts', 0) >= full_interval)
+            return self._refresh(full)
+
+    def start_auto_refresh(self, interval, full_interval=None):
+        """启动后台线程定期刷新（幂等）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._auto_refresh, args=(interval, full_interval), name='snapshot-refresh', daemon=True
+            )
+            self._thread.start()
+
+    def _auto_refresh(self, interval, full_interval):
+        while True:
+            try:
+                self.refresh_if_stale(interval, full_interval)
+            except Exception:
+                logger.exception('分析快照刷新失败：%s', self.snapshot_dir)
+            # 多进程部署时各进程都会检查，间隔取短一些，由文件锁和导出时间决定实际谁来刷新
+            time.sleep(min(interval, 60))
+
+    def _refresh(self, full):
+        current = read_current(self.snapshot_dir)
+        conn = self.connect()
+        try:
+            if current is None:
+                return self._export(conn, None)
+            if full:
+                # 全量导出沿用代号递增，不覆盖正在被读取的旧代快照
+                return self._export(conn, None, current[1]['generation'] + 1)
+            return self._export(conn, current)
+        finally:
+            conn.close()
+
+    def _export(self, conn, current, generation=1):
+        if current is None:
+            strings = StringDictionary()
+        else:
+            gen_dir, meta = current
+            with open(os.path.join(gen_dir, 'strings.json'), encoding='utf-8') as f:
+                strings = StringDictionary(json.load(f))
+            generation = meta['generation'] + 1
+
+        exported_on = date.today()
+        full_exported_ts = time.time() if current is None else meta.get('full_exported_ts', 0)
+        columns = {}
+
+        # 书籍、读者、分类体量较小且会被修改/删除，每次全量导出
+        for table in ('category', 'book', 'reader'):
+            names = [name for name, _ in TABLES[table]]
+            rows = self._fetch(conn, "SELECT %s FROM %s ORDER BY %s" % (", ".join(names), table, names[0]))
+            columns.update(self._encode(table, rows, strings))
+
+        # 借阅记录只追加新行：last_borrow_id 之后的行，以及回看窗口内上次导出后才提交的行
+        names = [name for name, _ in TABLES['borrow']]
+        if current is None:
+            last_borrow_id = 0
+            rows = self._fetch(conn, "SELECT %s FROM borrow ORDER BY borrow_id" % ", ".join(names))
+            columns.update(self._encode('borrow', rows, strings))
+        else:
+            last_borrow_id = meta['last_borrow_id']
+            rows = self._fetch(
+                conn,
+                "SELECT %s FROM borrow WHERE borrow_id > %%s ORDER BY borrow_id" % ", ".join(names),
+                (max(0, last_borrow_id - LATE_WINDOW),)
+            )
+            fresh = self._encode('borrow', rows, strings)
+            old = {name: np.load(os.path.join(gen_dir, 'borrow.%s.npy' % name)) for name in names}
+            _, exported = _lookup(old['borrow_id'], fresh['borrow.borrow_id'])
+            for name in names:
+                columns['borrow.' + name] = np.concatenate([old[name], fresh['borrow.' + name][~exported]])
+            # 晚提交的行 ID 小于已导出的行，重新按 borrow_id 排序
+            order = np.argsort(columns['borrow.borrow_id'], kind='stable')
+            if np.any(order != np.arange(len(order))):
+                for name in names:
+                    columns['borrow.' + name] = columns['borrow.' + name][order]
+
+            # 已有记录在上次导出当天及之后的归还需要回写
+            returned = self._fetch(
+                conn,
+                """SELECT borrow_id, actual_return_date FROM borrow
+                   WHERE borrow_id <= %s AND actual_return_date >= %s""",
+                (last_borrow_id, meta['exported_on'])
+            )
+            if returned:
+                borrow_ids = columns['borrow.borrow_id']
+                ids = np.array([row[0] for row in returned], dtype=np.int32)
+                dates = np.array([row[1].toordinal() for row in returned], dtype=np.int32)
+                pos, found = _lookup(borrow_ids, ids)
+                columns['borrow.actual_return_date'][pos[found]] = dates[found]
+
+        if len(columns['borrow.borrow_id']):
+            last_borrow_id = int(columns['borrow.borrow_id'][-1])
+
+        meta = {
+            'format': SNAPSHOT_FORMAT,
+            'generation': generation,
+            'last_borrow_id': last_borrow_id,
+            'exported_on': exported_on.isoformat(),
+            'exported_at': datetime.now().isoformat(timespec='seconds'),
+            'full_exported_ts': full_exported_ts,
+            'rows': {table: int(len(columns['%s.%s' % (table, TABLES[table][0][0])])) for table in TABLES},
+        }
+        self._write(generation, columns, strings, meta)
+        return meta
+
+    def _fetch(self, conn, sql, params=()):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            rows = []
+            while True:
+                chunk = cursor.fetchmany(FETCH_SIZE)
+                if not chunk:
+                    break
+                rows.extend(chunk)
+            return rows
+        finally:
+            cursor.close()
+
+    def _encode(self, table, rows, strings):
+        """将行数据按列编码为 NumPy 数组"""
+        columns = {}
+        for i, (name, kind) in enumerate(TABLES[table]):
+            if kind == 'str':
+                values = [strings.encode(row[i]) for row in rows]
+            elif kind == 'date':
+                values = [row[i].toordinal() if row[i] is not None else NULL_DATE for row in rows]
+            elif kind == 'id':
+                values = [row[i] if row[i] is not None else NULL_ID for row in rows]
+            else:
+                values = [row[i] or 0 for row in rows]
+            columns['%s.%s' % (table, name)] = np.array(values, dtype=np.int32)
+        return columns
+
+    def _write(self, generation, columns, strings, meta):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        name = 'gen-%06d' % generation
+        tmp_dir = os.path.join(self.snapshot_dir, '.%s.%d' % (name, os.getpid()))
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_dir, column + '.npy'), values)
+        with open(os.path.join(tmp_dir, 'strings.json'), 'w', encoding='utf-8') as f:
+            json.dump(strings.values, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        gen_dir = os.path.join(self.snapshot_dir, name)
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        os.rename(tmp_dir, gen_dir)
+
+        # 原子切换 CURRENT，正在读取旧快照的进程不受影响
+        pointer = os.path.join(self.snapshot_dir, 'CURRENT')
+        with open(pointer + '.tmp', 'w') as f:
+            f.write(name)
+        os.replace(pointer + '.tmp', pointer)
+        self._prune(generation)
+
+    def _prune(self, generation):
+        for entry in os.listdir(self.snapshot_dir):
+            if entry.startswith('gen-') and int(entry[4:]) <= generation - self.keep_generations:
+                shutil.rmtree(os.path.join(self.snapshot_dir, entry), ignore_errors=True)
+
+
+class _FileLock:
+    """快照目录上的跨进程文件锁，多个 worker 只允许一个同时刷新"""
+
+    def __init__(self, snapshot_dir, blocking=True):
+        self.path = os.path.join(snapshot_dir, '.lock')
+        self.blocking = blocking
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, 'w')
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        self._file.close()  # 关闭文件即释放锁
+
+
+def read_current(snapshot_dir):
+    """读取当前快照，返回 (目录, 元数据)，没有快照时返回 None"""
+    try:
+        with open(os.path.join(snapshot_dir, 'CURRENT')) as f:
+            gen_dir = os.path.join(snapshot_dir, f.read().strip())
+        with open(os.path.join(gen_dir, 'meta.json'), encoding='utf-8') as f:
+            return gen_dir, json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class _Snapshot:
+    """已映射到内存的一代快照"""
+
+    def __init__(self, gen_dir, meta):
+        self.meta = meta
+        self.exported_at = meta['exported_at']
+        self.exported_ts = _exported_ts(meta)
+        with open(os.path.join(gen_dir, 'strings.json'), encoding='utf-8') as f:
+            self.strings = StringDictionary(json.load(f))
+        self.tables = {
+            table: {
+                name: np.load(os.path.join(gen_dir, '%s.%s.npy' % (table, name)), mmap_mode='r')
+                for name, _ in columns
+            }
+            for table, columns in TABLES.items()
+        }
+
+
+class AnalyticsEngine:
+    """基于内存映射快照的统计引擎
+
+    超过 max_age 秒未刷新的快照视为过期，current() 返回 None，调用方应回退到在线查询。
+    """
+
+    def __init__(self, snapshot_dir, max_age=None):
+        self.snapshot_dir = snapshot_dir
+        self.max_age = max_age
+        self._snapshot_obj = None
+        self._pointer_key = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """当前可用的快照；没有快照或快照已过期返回 None"""
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return None
+        if self.max_age is not None and time.time() - snapshot.exported_ts > self.max_age:
+            return None
+        return snapshot
+
+    def available(self):
+        """是否存在未过期的快照"""
+        return self.current() is not None
+
+    def status(self):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return None
+        return dict(snapshot.meta, stale=self.current() is None)
+
+    def _snapshot(self):
+        """已加载的快照；每 CHECK_INTERVAL 秒最多 stat 一次 CURRENT，切换后才重新读取元数据"""
+        now = time.monotonic()
+        if now - self._checked_at < CHECK_INTERVAL:
+            return self._snapshot_obj
+        with self._lock:
+            if now - self._checked_at < CHECK_INTERVAL:
+                return self._snapshot_obj
+            self._checked_at = now
+            try:
+                st = os.stat(os.path.join(self.snapshot_dir, 'CURRENT'))
+            except OSError:
+                return self._snapshot_obj
+            key = (st.st_ino, st.st_mtime_ns)
+            if key != self._pointer_key:
+                current = read_current(self.snapshot_dir)
+                if current is not None:
+                    self._snapshot_obj = _Snapshot(*current)
+                    self._pointer_key = key
+            return self._snapshot_obj
+
+    def _borrow_book_index(self, snapshot):
+        """借阅记录对应的书籍下标；随书籍删除而级联删除的记录被过滤掉"""
+        book_ids = snapshot.tables['book']['book_id']
+        return _lookup(book_ids, snapshot.tables['borrow']['book_id'])
+
+    def book_popularity(self, limit=20, snapshot=None):
+        """书籍借阅排行榜"""
+        snapshot = snapshot or self._snapshot()
+        book = snapshot.tables['book']
+        category = snapshot.tables['category']
+        strings = snapshot.strings
+
+        book_idx, valid = self._borrow_book_index(snapshot)
+        counts = np.bincount(book_idx[valid], minlength=len(book['book_id']))
+        order = np.argsort(-counts, kind='stable')[:limit]
+
+        cat_idx, cat_found = _lookup(category['category_id'], book['category_id'][order])
+        result = []
+        for i, pos in enumerate(order):
+            result.append({
+                'book_id': int(book['book_id'][pos]),
+                'book_name': strings.decode(book['book_name'][pos]),
+                'author': strings.decode(book['author'][pos]),
+                'borrow_count': int(counts[pos]),
+                'total_count': int(book['total_count'][pos]),
+                'available_count': int(book['available_count'][pos]),
+                'category_name': strings.decode(category['category_name'][cat_idx[i]]) if cat_found[i] else None,
+            })
+        return result
+
+    def reader_activity(self, snapshot=None):
+        """读者借阅活跃度统计"""
+        snapshot = snapshot or self._snapshot()
+        reader = snapshot.tables['reader']
+        borrow = snapshot.tables['borrow']
+        strings = snapshot.strings
+        n = len(reader['reader_id'])
+
+        _, book_valid = self._borrow_book_index(snapshot)
+        reader_idx, reader_valid = _lookup(reader['reader_id'], borrow['reader_id'])
+        valid = book_valid & reader_valid
+        idx = reader_idx[valid]
+        borrow_dates = np.asarray(borrow['borrow_date'])[valid]
+        is_open = np.asarray(borrow['actual_return_date'])[valid] == NULL_DATE
+
+        total = np.bincount(idx, minlength=n)
+        current = np.bincount(idx[is_open], minlength=n)
+        first = np.full(n, np.iinfo(np.int32).max, dtype=np.int32)
+        latest = np.full(n, NULL_DATE, dtype=np.int32)
+        np.minimum.at(first, idx, borrow_dates)
+        np.maximum.at(latest, idx, borrow_dates)
+
+        result = []
+        for pos in np.argsort(-total, kind='stable'):
+            has_borrow = total[pos] > 0
+            result.append({
+                'reader_id': int(reader['reader_id'][pos]),
+                'name': strings.decode(reader['name'][pos]),
+                'gender': strings.decode(reader['gender'][pos]),
+                'total_borrow': int(total[pos]),
+                'current_borrow': int(current[pos]),
+                'first_borrow_date': _to_date(first[pos]) if has_borrow else None,
+                'latest_borrow_date': _to_date(latest[pos]) if has_borrow else None,
+            })
+        return result
+
+    def category_distribution(self, snapshot=None):
+        """图书分类分布统计"""
+        snapshot = snapshot or self._snapshot()
+        category = snapshot.tables['category']
+        book = snapshot.tables['book']
+        strings = snapshot.strings
+        n = len(category['category_id'])
+
+        book_idx, book_valid = self._borrow_book_index(snapshot)
+        borrow_per_book = np.bincount(book_idx[book_valid], minlength=len(book['book_id']))
+
+        cat_idx, cat_valid = _lookup(category['category_id'], book['category_id'])
+        idx = cat_idx[cat_valid]
+        book_count = np.bincount(idx, minlength=n)
+        total_copies = np.bincount(idx, weights=np.asarray(book['total_count'])[cat_valid], minlength=n)
+        available_copies = np.bincount(idx, weights=np.asarray(book['available_count'])[cat_valid], minlength=n)
+        total_borrow = np.bincount(idx, weights=borrow_per_book[cat_valid], minlength=n)
+
+        result = []
+        for pos in np.argsort(-book_count, kind='stable'):
+            has_book = book_count[pos] > 0
+            result.append({
+                'category_id': int(category['category_id'][pos]),
+                'category_name': strings.decode(category['category_name'][pos]),
+                'book_count': int(book_count[pos]),
+                'total_copies': int(total_copies[pos]) if has_book else None,
+                'available_copies': int(available_copies[pos]) if has_book else None,
+                'total_borrow': int(total_borrow[pos]),
+            })
+        return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from app import snapshot_exporters
+
+    parser = argparse.ArgumentParser(description='导出列式分析快照')
+    parser.add_argument('--full', action='store_true', help='忽略已有快照，全量导出')
+    parser.add_argument('--branch', action='append', help='只导出指定分馆（可重复），默认全部分馆')
+    args = parser.parse_args()
+
+    for branch in args.branch or list(snapshot_exporters):
+        meta = snapshot_exporters[branch].refresh(full=args.full)
+        print(branch, json.dumps(meta, ensure_ascii=False, indent=2))
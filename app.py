@@ -1,11 +1,23 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, render_template, request, jsonify, session, stream_with_context, has_request_context
 from flask_cors import CORS
 import mysql.connector
 from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 import hashlib
+import heapq
 import json
+import os
 from collections import defaultdict
 
+from admission import AdmissionClass, AdmissionController
+from analytics import AnalyticsEngine, SnapshotExporter
+from catalog_state import WarmStateManager
+from export import Workbook, csv_stream, iter_chunks, xlsx_stream
+from jobs import JobQueue, current_job
+from outbox import append_event, fetch_events
+from profiler import SamplingProfiler
+
 app = Flask(__name__)
 app.secret_key = 'library_system_secret_key'
 CORS(app)
@@ -18,14 +30,225 @@ DB_CONFIG = {
     'database': 'library_db'
 }
 
-def get_db_connection():
-    """获取数据库连接"""
-    return mysql.connector.connect(**DB_CONFIG)
+# 分馆分片：每个分馆的馆藏与借阅存放在独立的数据库中（各分片均用 sql/create.sql 建表，
+# 只需修改库名）。请求通过 ?branch= 参数或 X-Branch 请求头指定分馆，未指定时使用默认分馆；
+# 统计和搜索未指定分馆时在所有分片上并行查询后合并。管理员账号存放在默认分馆。
+BRANCH_SHARDS = {
+    'main': DB_CONFIG,
+    # 'east': {**DB_CONFIG, 'database': 'library_east'},
+}
+DEFAULT_BRANCH = 'main'
+
+# 列式分析快照目录（每个分馆一个子目录）
+ANALYTICS_SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analytics_snapshot')
+# 后台增量刷新间隔（秒）；快照超过最大时长未刷新时统计接口回退到在线查询
+ANALYTICS_REFRESH_INTERVAL = 300
+ANALYTICS_SNAPSHOT_MAX_AGE = 900
+# 定期全量导出，兜底修正增量刷新回看窗口之外的偏差
+ANALYTICS_FULL_EXPORT_INTERVAL = 24 * 3600
+
+# 内存派生状态（检索结构、热度排行、分类查找）的热启动快照文件（每个分馆一个）
+CATALOG_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog_state.%s.snapshot')
+
+# 后台报表结果目录与结果新鲜期（秒）
+REPORT_RESULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report_results')
+REPORT_FRESHNESS = 300
+
+# 准入控制：各并发等级的并发上限、排队长度、排队等待秒数、查询超时秒数、Retry-After 秒数
+admission = AdmissionController(
+    [
+        AdmissionClass('circulation', max_concurrent=16, max_queue=64, queue_timeout=5,
+                       query_timeout=5, retry_after=1),
+        AdmissionClass('browse', max_concurrent=8, max_queue=32, queue_timeout=3,
+                       query_timeout=10, retry_after=2),
+        AdmissionClass('analytics', max_concurrent=2, max_queue=4, queue_timeout=1,
+                       query_timeout=30, retry_after=10),
+        # 导出会长时间占用连接，不设查询超时，靠并发上限保护
+        AdmissionClass('export', max_concurrent=2, max_queue=2, queue_timeout=1,
+                       query_timeout=0, retry_after=30),
+    ],
+    {
+        # 借还书及前台写操作
+        'borrow_book': 'circulation',
+        'return_book': 'circulation',
+        'register_reader': 'circulation',
+        'add_book': 'circulation',
+        'update_book': 'circulation',
+        'delete_book': 'circulation',
+        # 查询浏览
+        'login': 'browse',
+        'list_books': 'browse',
+        'search_books': 'browse',
+        'search_by_author': 'browse',
+        'list_readers': 'browse',
+        'borrow_records': 'browse',
+        'recommend_books': 'browse',
+        'similar_books': 'browse',
+        # 统计报表
+        'book_popularity': 'analytics',
+        'reader_activity': 'analytics',
+        'category_distribution': 'analytics',
+        'overdue_books': 'analytics',
+        'borrow_trend': 'analytics',
+        'library_overview': 'analytics',
+        # 数据导出
+        'export_borrow_records': 'export',
+        'export_reader_activity': 'export',
+    }
+)
+admission.init_app(app)
+
+# 按需采样分析器（管理员开启）
+profiler = SamplingProfiler()
+profiler.init_app(app)
+
+def current_branch():
+    """当前请求所属分馆"""
+    if not has_request_context():
+        return DEFAULT_BRANCH
+    return request.args.get('branch') or request.headers.get('X-Branch') or DEFAULT_BRANCH
+
+def request_branches():
+    """统计/搜索涉及的分馆：指定了分馆时只查该分馆，否则查询全部分馆"""
+    branch = request.args.get('branch') or request.headers.get('X-Branch')
+    return [branch] if branch else list(BRANCH_SHARDS)
+
+@app.before_request
+def check_branch():
+    """校验分馆参数"""
+    if current_branch() not in BRANCH_SHARDS:
+        return jsonify({'success': False, 'message': '未知的分馆'}), 400
+
+def get_db_connection(branch=None, query_timeout=None):
+    """获取数据库连接（默认连接当前请求所属分馆，并按当前请求的并发等级设置查询超时）"""
+    branch = branch or current_branch()
+    conn = profiler.instrument(mysql.connector.connect(**BRANCH_SHARDS[branch]))
+    
+    # 报表任务中的连接需要登记，取消任务时终止其正在执行的查询
+    job = current_job()
+    if job is not None:
+        job.track_connection(branch, conn.connection_id)
+    
+    timeout = admission.query_timeout() if query_timeout is None else query_timeout
+    if timeout:
+        cursor = conn.cursor()
+        try:
+            # MAX_EXECUTION_TIME 限制只读查询，innodb_lock_wait_timeout 限制写操作的锁等待
+            cursor.execute(
+                "SET SESSION MAX_EXECUTION_TIME = %s, innodb_lock_wait_timeout = %s",
+                (int(timeout * 1000), max(1, int(timeout)))
+            )
+        finally:
+            cursor.close()
+    return conn
+
+# 分片并行查询线程池：每个分片一个，在 register_branch 中创建，新增分片时并行能力随之增加，
+# 某个分片变慢也只占满它自己的线程。线程数按同时合并查询的请求数估算：
+# 查询浏览与统计等级的并发上限加上报表任务线程数
+SHARD_POOL_WORKERS = 12
+shard_pools = {}
+
+def scatter_gather(fn, branches=None):
+    """在多个分片上并行执行 fn(branch, query_timeout)，按分馆顺序返回 [(branch, 结果)]"""
+    branches = branches or request_branches()
+    # 工作线程中没有请求上下文，查询超时在这里取好传下去
+    timeout = admission.query_timeout()
+    
+    # 在报表任务中执行时，分片线程同样归属于该任务（用于取消），每完成一个分片推进一次进度
+    job = current_job()
+    if job is not None:
+        job.set_total(job.total_steps + len(branches))
+        task = job.bind(fn)
+        
+        def fn(branch, timeout):
+            result = task(branch, timeout)
+            job.advance()
+            return result
+    
+    if len(branches) == 1:
+        return [(branches[0], fn(branches[0], timeout))]
+    # 被采样的请求，其分片线程同样纳入采样与数据库计时
+    fn = profiler.bind(fn)
+    futures = [(branch, shard_pools[branch].submit(fn, branch, timeout)) for branch in branches]
+    return [(branch, future.result()) for branch, future in futures]
+
+def query_shards(sql, params=(), fetch_one=False, branches=None):
+    """在多个分片上并行执行同一条查询，返回 [(branch, 结果)]"""
+    def run(branch, timeout):
+        conn = get_db_connection(branch, timeout)
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchone() if fetch_one else cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+    return scatter_gather(run, branches)
+
+def tag_branch(results):
+    """合并各分片的结果列表，并为每行标注所属分馆"""
+    return [dict(row, branch=branch) for branch, rows in results for row in rows]
+
+def sum_values(values):
+    """求和，忽略 NULL；全部为 NULL 时返回 None"""
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+analytics_engines = {}
+snapshot_exporters = {}
+warm_states = {}
+
+def register_branch(branch, config):
+    """登记一个分馆分片，并创建它的列式分析快照与内存派生状态"""
+    BRANCH_SHARDS[branch] = config
+    if branch not in shard_pools:
+        shard_pools[branch] = ThreadPoolExecutor(max_workers=SHARD_POOL_WORKERS,
+                                                 thread_name_prefix='shard-%s' % branch)
+    snapshot_dir = os.path.join(ANALYTICS_SNAPSHOT_DIR, branch)
+    analytics_engines[branch] = AnalyticsEngine(snapshot_dir, max_age=ANALYTICS_SNAPSHOT_MAX_AGE)
+    snapshot_exporters[branch] = SnapshotExporter(snapshot_dir, partial(get_db_connection, branch, 0))
+    warm_states[branch] = WarmStateManager(CATALOG_STATE_PATH % branch, partial(get_db_connection, branch, 0))
+
+for name, config in list(BRANCH_SHARDS.items()):
+    register_branch(name, config)
+
+def kill_query(branch, connection_id):
+    """终止指定连接上正在执行的查询"""
+    conn = get_db_connection(branch, 0)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("KILL QUERY %s", (connection_id,))
+    finally:
+        cursor.close()
+        conn.close()
+
+# 后台报表任务：耗时统计在工作线程中执行，结果带时间戳保存，新鲜期内直接复用
+report_jobs = JobQueue(REPORT_RESULT_DIR, kill_query, max_workers=2, freshness=REPORT_FRESHNESS)
+
+def warm_states_ready(branches):
+    return all(warm_states[branch].ready.is_set() for branch in branches)
+
+@app.before_request
+def start_warm_state():
+    """首个请求到达时在后台加载内存派生状态，并启动分析快照的定期刷新"""
+    for manager in warm_states.values():
+        manager.ensure_started()
+    for exporter in snapshot_exporters.values():
+        exporter.start_auto_refresh(ANALYTICS_REFRESH_INTERVAL, ANALYTICS_FULL_EXPORT_INTERVAL)
 
 def hash_password(password):
     """密码加密"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+def admin_required(f):
+    """要求管理员已登录"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if 'admin_id' not in session:
+            return jsonify({'success': False, 'message': '请先登录管理员账号'}), 401
+        return f(*args, **kwargs)
+    return wrapper
+
 @app.route('/')
 def index():
     """渲染主页"""
@@ -38,7 +261,8 @@ def login():
     username = data.get('username')
     password = data.get('password')
     
-    conn = get_db_connection()
+    # 管理员账号存放在默认分馆
+    conn = get_db_connection(DEFAULT_BRANCH)
     cursor = conn.cursor(dictionary=True)
     
     try:
@@ -76,9 +300,12 @@ def register_reader():
             "INSERT INTO reader (name, gender, phone) VALUES (%s, %s, %s)",
             (name, gender, phone)
         )
+        append_event(cursor, 'reader_registered', cursor.lastrowid,
+                     {'name': name, 'gender': gender, 'phone': phone})
         conn.commit()
         return jsonify({'success': True, 'message': '读者注册成功'})
     except Exception as e:
+        conn.rollback()
         return jsonify({'success': False, 'message': str(e)})
     finally:
         cursor.close()
@@ -92,7 +319,14 @@ def add_book():
     author = data.get('author')
     publisher = data.get('publisher')
     category_name = data.get('category_name')
-    total_count = data.get('total_count', 1)
+    total_count = data.get('total_count')
+    try:
+        # 只有未提供数量时才默认为 1；0、空字符串等无效值直接拒绝
+        total_count = 1 if total_count is None else int(total_count)
+    except (TypeError, ValueError):
+        total_count = 0
+    if total_count <= 0:
+        return jsonify({'success': False, 'message': '书籍数量无效'})
     
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -124,6 +358,7 @@ def add_book():
                 "UPDATE book SET total_count = total_count + %s, available_count = available_count + %s WHERE book_id = %s",
                 (total_count, total_count, existing_book[0])
             )
+            append_event(cursor, 'book_restocked', existing_book[0], {'count': total_count})
         else:
             # 添加新书
             cursor.execute(
@@ -131,6 +366,14 @@ def add_book():
                    VALUES (%s, %s, %s, %s, %s, %s)""",
                 (book_name, author, publisher, category_id, total_count, total_count)
             )
+            append_event(cursor, 'book_added', cursor.lastrowid, {
+                'book_name': book_name,
+                'author': author,
+                'publisher': publisher,
+                'category_id': category_id,
+                'category_name': category_name,
+                'total_count': total_count
+            })
         
         conn.commit()
         return jsonify({'success': True, 'message': '书籍添加成功'})
@@ -159,13 +402,17 @@ def delete_book(book_id):
             return jsonify({'success': False, 'message': '该书已被借出，无法删除'})
         
         cursor.execute("DELETE FROM book WHERE book_id = %s", (book_id,))
+        deleted = cursor.rowcount
+        if deleted > 0:
+            append_event(cursor, 'book_deleted', book_id)
         conn.commit()
         
-        if cursor.rowcount > 0:
+        if deleted > 0:
             return jsonify({'success': True, 'message': '书籍删除成功'})
         else:
             return jsonify({'success': False, 'message': '未找到该书籍'})
     except Exception as e:
+        conn.rollback()
         return jsonify({'success': False, 'message': str(e)})
     finally:
         cursor.close()
@@ -194,51 +441,50 @@ def list_books():
 
 @app.route('/api/search_books', methods=['GET'])
 def search_books():
-    """搜索书籍"""
+    """搜索书籍（未指定分馆时在所有分馆中搜索）"""
     keyword = request.args.get('keyword', '')
+    branches = request_branches()
     
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    # 内存状态就绪后直接在内存中检索
+    if warm_states_ready(branches):
+        return jsonify({'success': True, 'data': tag_branch(
+            (branch, warm_states[branch].state.search(keyword)) for branch in branches
+        )})
     
     try:
-        cursor.execute("""
+        results = query_shards("""
             SELECT b.*, c.category_name 
             FROM book b 
             LEFT JOIN category c ON b.category_id = c.category_id
             WHERE b.book_name LIKE %s OR b.author LIKE %s OR b.publisher LIKE %s
         """, (f'%{keyword}%', f'%{keyword}%', f'%{keyword}%'))
         
-        books = cursor.fetchall()
-        return jsonify({'success': True, 'data': books})
+        return jsonify({'success': True, 'data': tag_branch(results)})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.route('/api/search_by_author', methods=['GET'])
 def search_by_author():
-    """根据作者搜索书籍"""
+    """根据作者搜索书籍（未指定分馆时在所有分馆中搜索）"""
     author = request.args.get('author', '')
+    branches = request_branches()
     
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    if warm_states_ready(branches):
+        return jsonify({'success': True, 'data': tag_branch(
+            (branch, warm_states[branch].state.search_by_author(author)) for branch in branches
+        )})
     
     try:
-        cursor.execute("""
+        results = query_shards("""
             SELECT b.*, c.category_name 
             FROM book b 
             LEFT JOIN category c ON b.category_id = c.category_id
             WHERE b.author LIKE %s
         """, (f'%{author}%',))
         
-        books = cursor.fetchall()
-        return jsonify({'success': True, 'data': books})
+        return jsonify({'success': True, 'data': tag_branch(results)})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.route('/api/update_book/<int:book_id>', methods=['PUT'])
 def update_book(book_id):
@@ -269,10 +515,19 @@ def update_book(book_id):
             SET book_name = %s, author = %s, publisher = %s, category_id = %s
             WHERE book_id = %s
         """, (book_name, author, publisher, category_id, book_id))
+        updated = cursor.rowcount
+        if updated > 0:
+            append_event(cursor, 'book_updated', book_id, {
+                'book_name': book_name,
+                'author': author,
+                'publisher': publisher,
+                'category_id': category_id,
+                'category_name': category_name
+            })
         
         conn.commit()
         
-        if cursor.rowcount > 0:
+        if updated > 0:
             return jsonify({'success': True, 'message': '书籍信息更新成功'})
         else:
             return jsonify({'success': False, 'message': '未找到该书籍'})
@@ -300,24 +555,29 @@ def borrow_book():
     try:
         # 检查读者是否存在
         cursor.execute("SELECT reader_id FROM reader WHERE reader_id = %s", (reader_id,))
-        if not cursor.fetchone():
+        reader = cursor.fetchone()
+        if not reader:
             return jsonify({'success': False, 'message': '读者不存在'})
+        reader_id = reader[0]
         
         # 检查书籍库存
-        cursor.execute("SELECT available_count FROM book WHERE book_id = %s", (book_id,))
+        cursor.execute("SELECT book_id, available_count FROM book WHERE book_id = %s", (book_id,))
         book = cursor.fetchone()
         
         if not book:
             return jsonify({'success': False, 'message': '书籍不存在'})
         
-        if book[0] <= 0:
+        if book[1] <= 0:
             return jsonify({'success': False, 'message': '该书已被全部借出'})
+        # 使用数据库中读出的ID，事件中不记录客户端原始输入
+        book_id = book[0]
         
         # 创建借阅记录
         cursor.execute("""
             INSERT INTO borrow (reader_id, book_id, borrow_date, return_date, status)
             VALUES (%s, %s, %s, %s, '借出')
         """, (reader_id, book_id, borrow_date, return_date))
+        borrow_id = cursor.lastrowid
         
         # 更新书籍可用数量
         cursor.execute("""
@@ -325,6 +585,14 @@ def borrow_book():
             WHERE book_id = %s AND available_count > 0
         """, (book_id,))
         
+        # 事件最后写入：前面的语句锁等待超时回滚时不会占用事件序号，留下空洞
+        append_event(cursor, 'book_borrowed', borrow_id, {
+            'reader_id': reader_id,
+            'book_id': book_id,
+            'borrow_date': borrow_date,
+            'return_date': return_date
+        })
+        
         conn.commit()
         return jsonify({'success': True, 'message': '借书成功'})
     except Exception as e:
@@ -346,13 +614,13 @@ def return_book():
     
     try:
         # 获取借书记录和书籍ID
-        cursor.execute("SELECT book_id FROM borrow WHERE borrow_id = %s", (borrow_id,))
+        cursor.execute("SELECT borrow_id, book_id FROM borrow WHERE borrow_id = %s", (borrow_id,))
         record = cursor.fetchone()
         
         if not record:
             return jsonify({'success': False, 'message': '借书记录不存在'})
         
-        book_id = record[0]
+        borrow_id, book_id = record
         
         # 更新借书记录
         cursor.execute("""
@@ -360,16 +628,22 @@ def return_book():
             SET actual_return_date = %s, status = '已归还'
             WHERE borrow_id = %s AND actual_return_date IS NULL
         """, (actual_return_date, borrow_id))
+        returned = cursor.rowcount
         
-        # 更新书籍可用数量
-        cursor.execute("""
-            UPDATE book SET available_count = available_count + 1 
-            WHERE book_id = %s
-        """, (book_id,))
+        # 更新书籍可用数量（重复还书不再增加库存）
+        if returned > 0:
+            cursor.execute("""
+                UPDATE book SET available_count = available_count + 1 
+                WHERE book_id = %s
+            """, (book_id,))
+            append_event(cursor, 'book_returned', borrow_id, {
+                'book_id': book_id,
+                'actual_return_date': actual_return_date
+            })
         
         conn.commit()
         
-        if cursor.rowcount > 0:
+        if returned > 0:
             return jsonify({'success': True, 'message': '还书成功'})
         else:
             return jsonify({'success': False, 'message': '该书已归还或记录不存在'})
@@ -420,15 +694,64 @@ def list_readers():
         conn.close()
 
 # ==================== 新增的复杂查询和统计功能 ====================
+# 未指定分馆时，统计在所有分馆的分片上并行执行（scatter-gather），再合并各分片结果
+
+def snapshot_or_query(method, sql, snapshot_at=None):
+    """生成分片查询函数：该分馆有未过期的列式快照时读快照，否则查询数据库
+    
+    传入 snapshot_at 字典时记录各分馆所用快照的导出时间（在线查询记为 None）
+    """
+    def run(branch, timeout):
+        snapshot = analytics_engines[branch].current()
+        if snapshot_at is not None:
+            snapshot_at[branch] = snapshot.exported_at if snapshot else None
+        if snapshot is not None:
+            return getattr(analytics_engines[branch], method)(snapshot=snapshot)
+        
+        conn = get_db_connection(branch, timeout)
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(sql)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+    return run
+
+def report_or_job(report, gather_from_snapshot=None):
+    """耗时统计接口的统一入口，不在请求线程中执行在线聚合查询
+    
+    所有分馆都有未过期的列式快照时直接读快照计算；否则返回新鲜期内已保存的报表结果；
+    都没有时提交后台报表任务，返回 202 和任务信息，由前端轮询 /api/reports/jobs/<job_id>
+    """
+    branches = request_branches()
+    if gather_from_snapshot is not None and all(analytics_engines[branch].current() for branch in branches):
+        snapshot_at = {}
+        data = gather_from_snapshot(branches, snapshot_at)
+        return jsonify({'success': True, 'data': data, 'snapshot_at': snapshot_at})
+    
+    job, stored = report_jobs.submit(report, {'branches': branches})
+    if stored is not None:
+        result, finished_at = stored
+        return jsonify({'success': True, 'data': result, 'finished_at': finished_at})
+    return jsonify({'success': True, 'pending': True, 'job': job}), 202
+
+def merge_counts(results, key):
+    """按 key 合并各分片的 borrow_count / unique_readers（读者按分馆划分，互不重复）"""
+    merged = {}
+    for rows in results:
+        for row in rows:
+            item = merged.setdefault(row[key], {key: row[key], 'borrow_count': 0, 'unique_readers': 0})
+            item['borrow_count'] += row['borrow_count']
+            item['unique_readers'] += row['unique_readers']
+    return [merged[value] for value in sorted(merged)]
 
 @app.route('/api/statistics/book_popularity', methods=['GET'])
 def book_popularity():
-    """书籍借阅排行榜（复杂查询：多表联接 + 聚合函数）"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
+    """书籍借阅排行榜（复杂查询：多表联接 + 聚合函数；各分馆取前 20 后归并）"""
     try:
-        cursor.execute("""
+        snapshot_at = {}
+        results = scatter_gather(snapshot_or_query('book_popularity', """
             SELECT 
                 b.book_id,
                 b.book_name,
@@ -443,86 +766,93 @@ def book_popularity():
             GROUP BY b.book_id, b.book_name, b.author, b.total_count, b.available_count, c.category_name
             ORDER BY borrow_count DESC
             LIMIT 20
-        """)
-        popular_books = cursor.fetchall()
-        return jsonify({'success': True, 'data': popular_books})
+        """, snapshot_at))
+        popular_books = heapq.nlargest(20, tag_branch(results), key=lambda book: book['borrow_count'])
+        return jsonify({'success': True, 'data': popular_books, 'snapshot_at': snapshot_at})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        cursor.close()
-        conn.close()
+
+def gather_reader_activity(branches=None, snapshot_at=None):
+    """各分馆读者借阅活跃度，合并后按借阅次数排序"""
+    results = scatter_gather(snapshot_or_query('reader_activity', """
+        SELECT 
+            r.reader_id,
+            r.name,
+            r.gender,
+            COUNT(br.borrow_id) as total_borrow,
+            COUNT(CASE WHEN br.actual_return_date IS NULL THEN 1 END) as current_borrow,
+            MIN(br.borrow_date) as first_borrow_date,
+            MAX(br.borrow_date) as latest_borrow_date
+        FROM reader r
+        LEFT JOIN borrow br ON r.reader_id = br.reader_id
+        GROUP BY r.reader_id, r.name, r.gender
+        ORDER BY total_borrow DESC
+    """, snapshot_at), branches)
+    return sorted(tag_branch(results), key=lambda reader: reader['total_borrow'], reverse=True)
 
 @app.route('/api/statistics/reader_activity', methods=['GET'])
 def reader_activity():
     """读者借阅活跃度统计（复杂查询：多表联接 + 聚合函数）"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
     try:
-        cursor.execute("""
-            SELECT 
-                r.reader_id,
-                r.name,
-                r.gender,
-                COUNT(br.borrow_id) as total_borrow,
-                COUNT(CASE WHEN br.actual_return_date IS NULL THEN 1 END) as current_borrow,
-                MIN(br.borrow_date) as first_borrow_date,
-                MAX(br.borrow_date) as latest_borrow_date
-            FROM reader r
-            LEFT JOIN borrow br ON r.reader_id = br.reader_id
-            GROUP BY r.reader_id, r.name, r.gender
-            ORDER BY total_borrow DESC
-        """)
-        reader_stats = cursor.fetchall()
-        return jsonify({'success': True, 'data': reader_stats})
+        return report_or_job('reader_activity', gather_reader_activity)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        cursor.close()
-        conn.close()
+
+def gather_category_distribution(branches=None, snapshot_at=None):
+    """各分馆图书分类分布，按分类名称合并
+    
+    各分馆的分类ID互不相关，合并结果不返回单一的 category_id，而是 category_ids：{分馆: 分类ID}
+    """
+    results = scatter_gather(snapshot_or_query('category_distribution', """
+        SELECT 
+            c.category_id,
+            c.category_name,
+            COUNT(b.book_id) as book_count,
+            SUM(b.total_count) as total_copies,
+            SUM(b.available_count) as available_copies,
+            COALESCE(SUM(br.borrow_count), 0) as total_borrow
+        FROM category c
+        LEFT JOIN book b ON c.category_id = b.category_id
+        LEFT JOIN (
+            SELECT book_id, COUNT(*) as borrow_count
+            FROM borrow
+            GROUP BY book_id
+        ) br ON b.book_id = br.book_id
+        GROUP BY c.category_id, c.category_name
+        ORDER BY book_count DESC
+    """, snapshot_at), branches)
+    
+    merged = {}
+    for branch, rows in results:
+        for row in rows:
+            item = merged.get(row['category_name'])
+            if item is None:
+                item = dict(row, category_ids={branch: row['category_id']})
+                del item['category_id']
+                merged[row['category_name']] = item
+                continue
+            item['category_ids'][branch] = row['category_id']
+            item['book_count'] += row['book_count']
+            item['total_copies'] = sum_values([item['total_copies'], row['total_copies']])
+            item['available_copies'] = sum_values([item['available_copies'], row['available_copies']])
+            item['total_borrow'] += row['total_borrow']
+    
+    return sorted(merged.values(), key=lambda item: item['book_count'], reverse=True)
 
 @app.route('/api/statistics/category_distribution', methods=['GET'])
 def category_distribution():
-    """图书分类分布统计（复杂查询：多表联接 + 聚合函数）"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
+    """图书分类分布统计（复杂查询：多表联接 + 聚合函数；各分馆按分类名称合并）"""
     try:
-        cursor.execute("""
-            SELECT 
-                c.category_id,
-                c.category_name,
-                COUNT(b.book_id) as book_count,
-                SUM(b.total_count) as total_copies,
-                SUM(b.available_count) as available_copies,
-                COALESCE(SUM(br.borrow_count), 0) as total_borrow
-            FROM category c
-            LEFT JOIN book b ON c.category_id = b.category_id
-            LEFT JOIN (
-                SELECT book_id, COUNT(*) as borrow_count
-                FROM borrow
-                GROUP BY book_id
-            ) br ON b.book_id = br.book_id
-            GROUP BY c.category_id, c.category_name
-            ORDER BY book_count DESC
-        """)
-        category_stats = cursor.fetchall()
-        return jsonify({'success': True, 'data': category_stats})
+        return report_or_job('category_distribution', gather_category_distribution)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.route('/api/statistics/overdue_books', methods=['GET'])
 def overdue_books():
     """逾期未还书籍查询（复杂查询：条件过滤 + 日期计算）"""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
     try:
         today = date.today()
-        cursor.execute("""
+        results = query_shards("""
             SELECT 
                 br.borrow_id,
                 r.reader_id,
@@ -547,18 +877,14 @@ def overdue_books():
             ORDER BY overdue_days DESC
         """, (today, today, today, today))
         
-        overdue_books = cursor.fetchall()
+        overdue_books = sorted(tag_branch(results), key=lambda item: item['overdue_days'], reverse=True)
         return jsonify({'success': True, 'data': overdue_books})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        cursor.close()
-        conn.close()
 
-@app.route('/api/statistics/borrow_trend', methods=['GET'])
-def borrow_trend():
-    """借阅趋势统计（复杂查询：按时间分组聚合）"""
-    conn = get_db_connection()
+def shard_borrow_trend(branch, timeout):
+    """单个分片的按日、按月借阅趋势"""
+    conn = get_db_connection(branch, timeout)
     cursor = conn.cursor(dictionary=True)
     
     try:
@@ -589,24 +915,30 @@ def borrow_trend():
         """)
         
         monthly_data = cursor.fetchall()
-        
-        return jsonify({
-            'success': True, 
-            'data': {
-                'daily': trend_data,
-                'monthly': monthly_data
-            }
-        })
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+        return trend_data, monthly_data
     finally:
         cursor.close()
         conn.close()
 
-@app.route('/api/statistics/library_overview', methods=['GET'])
-def library_overview():
-    """图书馆总览统计（多个聚合查询）"""
-    conn = get_db_connection()
+def gather_borrow_trend(branches=None):
+    """各分馆借阅趋势，按日期/月份合并"""
+    results = [data for branch, data in scatter_gather(shard_borrow_trend, branches)]
+    return {
+        'daily': merge_counts([daily for daily, monthly in results], 'borrow_day'),
+        'monthly': merge_counts([monthly for daily, monthly in results], 'borrow_month')
+    }
+
+@app.route('/api/statistics/borrow_trend', methods=['GET'])
+def borrow_trend():
+    """借阅趋势统计（复杂查询：按时间分组聚合）"""
+    try:
+        return report_or_job('borrow_trend')
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+def shard_library_overview(branch, timeout, author_limit=5):
+    """单个分片的总览统计；多分片合并热门作者时不截断，避免漏掉各分馆都不在前列的作者"""
+    conn = get_db_connection(branch, timeout)
     cursor = conn.cursor(dictionary=True)
     
     try:
@@ -645,26 +977,339 @@ def library_overview():
             FROM book
             GROUP BY author
             ORDER BY book_count DESC
-            LIMIT 5
-        """)
+        """ + ("LIMIT %d" % author_limit if author_limit else ""))
         top_authors = cursor.fetchall()
         
+        return {
+            'books': book_stats,
+            'readers': reader_stats,
+            'borrows': borrow_stats,
+            'overdue': overdue_stats,
+            'top_authors': top_authors
+        }
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/api/statistics/library_overview', methods=['GET'])
+def library_overview():
+    """图书馆总览统计（多个聚合查询）"""
+    try:
+        branches = request_branches()
+        author_limit = 5 if len(branches) == 1 else None
+        results = [data for branch, data in scatter_gather(partial(shard_library_overview, author_limit=author_limit), branches)]
+        
+        author_counts = defaultdict(int)
+        for data in results:
+            for item in data['top_authors']:
+                author_counts[item['author']] += item['book_count']
+        top_authors = heapq.nlargest(5, author_counts.items(), key=lambda item: item[1])
+        
+        def merge(section, keys):
+            return {key: sum_values([data[section][key] for data in results]) for key in keys}
+        
         return jsonify({
             'success': True,
             'data': {
-                'books': book_stats,
-                'readers': reader_stats,
-                'borrows': borrow_stats,
-                'overdue': overdue_stats,
-                'top_authors': top_authors
+                'books': merge('books', ('total_books', 'total_copies')),
+                'readers': merge('readers', ('total_readers',)),
+                'borrows': merge('borrows', ('total_borrows', 'current_borrows', 'returned_borrows')),
+                'overdue': merge('overdue', ('overdue_count',)),
+                'top_authors': [{'author': author, 'book_count': count} for author, count in top_authors]
             }
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/statistics/snapshot', methods=['GET'])
+def analytics_snapshot_status():
+    """查看各分馆列式分析快照状态"""
+    return jsonify({'success': True, 'data': {
+        branch: analytics_engines[branch].status() for branch in request_branches()
+    }})
+
+@app.route('/api/statistics/snapshot/refresh', methods=['POST'])
+@admin_required
+def refresh_analytics_snapshot():
+    """刷新列式分析快照（默认从上次的 borrow_id 增量刷新，未指定分馆时刷新全部分馆）"""
+    data = request.json or {}
+    full = bool(data.get('full'))
+    
+    try:
+        results = scatter_gather(lambda branch, timeout: snapshot_exporters[branch].refresh(full=full))
+        return jsonify({'success': True, 'message': '快照刷新成功', 'data': dict(results)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+# ==================== 后台报表任务 ====================
+
+report_jobs.register('reader_activity', lambda job, params: gather_reader_activity(params['branches']))
+report_jobs.register('category_distribution', lambda job, params: gather_category_distribution(params['branches']))
+report_jobs.register('borrow_trend', lambda job, params: gather_borrow_trend(params['branches']))
+
+@app.route('/api/reports/<report>', methods=['POST'])
+def submit_report(report):
+    """提交报表任务，立即返回任务ID；新鲜期内已有结果时直接返回结果（force=true 强制重新计算）"""
+    if report not in report_jobs.reports:
+        return jsonify({'success': False, 'message': '未知的报表'}), 404
+    data = request.get_json(silent=True) or {}
+    params = {'branches': request_branches()}
+    
+    job, stored = report_jobs.submit(report, params, force=bool(data.get('force')))
+    if stored is not None:
+        result, finished_at = stored
+        return jsonify({'success': True, 'data': {
+            'report': report,
+            'params': params,
+            'status': 'done',
+            'cached': True,
+            'finished_at': finished_at,
+            'result': result
+        }})
+    return jsonify({'success': True, 'data': job}), 202
+
+@app.route('/api/reports/jobs', methods=['GET'])
+@admin_required
+def list_report_jobs():
+    """列出最近的报表任务"""
+    return jsonify({'success': True, 'data': report_jobs.list()})
+
+@app.route('/api/reports/jobs/<job_id>', methods=['GET'])
+def report_job_status(job_id):
+    """查看报表任务进度，完成后返回结果"""
+    job = report_jobs.get(job_id, include_result=True)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    return jsonify({'success': True, 'data': job})
+
+@app.route('/api/reports/jobs/<job_id>', methods=['DELETE'])
+@admin_required
+def cancel_report_job(job_id):
+    """取消报表任务"""
+    if report_jobs.cancel(job_id):
+        return jsonify({'success': True, 'message': '任务已取消'})
+    return jsonify({'success': False, 'message': '任务不存在或已结束'})
+
+@app.route('/api/outbox/events', methods=['GET'])
+@admin_required
+def outbox_events():
+    """按序号分批读取事件日志"""
+    after = request.args.get('after', 0, type=int)
+    limit = min(request.args.get('limit', 500, type=int), 5000)
+    
+    conn = get_db_connection()
+    
+    try:
+        events = fetch_events(conn, after, limit)
+        next_seq = events[-1]['seq'] if events else after
+        return jsonify({'success': True, 'data': events, 'next': next_seq})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
     finally:
-        cursor.close()
         conn.close()
 
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    """就绪检查：所有分馆的内存派生状态加载并追平事件日志后返回 200"""
+    branches = {branch: manager.status() for branch, manager in warm_states.items()}
+    ready = all(status['ready'] for status in branches.values())
+    return jsonify({'success': ready, 'data': {'ready': ready, 'branches': branches}}), 200 if ready else 503
+
+@app.route('/api/admin/profiler/start', methods=['POST'])
+@admin_required
+def start_profiler():
+    """开启采样：可指定路由（endpoint 名）、请求抽样百分比、持续秒数与采样间隔"""
+    data = request.json or {}
+    
+    try:
+        started = profiler.start(
+            route=data.get('route'),
+            percent=data.get('percent', 100),
+            duration=data.get('duration', 60),
+            interval_ms=data.get('interval_ms', 10)
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': str(e)})
+    
+    if not started:
+        return jsonify({'success': False, 'message': '已有采样正在进行'})
+    return jsonify({'success': True, 'message': '采样已开启', 'data': profiler.report()})
+
+@app.route('/api/admin/profiler/stop', methods=['POST'])
+@admin_required
+def stop_profiler():
+    """提前结束采样"""
+    profiler.stop()
+    return jsonify({'success': True, 'message': '采样已停止'})
+
+@app.route('/api/admin/profiler', methods=['GET'])
+@admin_required
+def profiler_report():
+    """查看采样状态以及各路由墙钟耗时与数据库等待等分类耗时"""
+    return jsonify({'success': True, 'data': profiler.report()})
+
+@app.route('/api/admin/profiler/collapsed', methods=['GET'])
+@admin_required
+def profiler_collapsed():
+    """导出折叠栈文件（可用 flamegraph.pl 或 speedscope 生成火焰图）"""
+    return Response(
+        profiler.collapsed(),
+        mimetype='text/plain',
+        headers={'Content-Disposition': 'attachment; filename=profile.collapsed'}
+    )
+
+@app.route('/api/admission/stats', methods=['GET'])
+def admission_stats():
+    """查看各并发等级的排队深度与拒绝次数"""
+    return jsonify({'success': True, 'data': admission.stats()})
+
+# ==================== 数据导出（流式） ====================
+
+def stream_export(sql, params, header, filename):
+    """执行查询并以流式响应导出 CSV / XLSX"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'xlsx'):
+        return jsonify({'success': False, 'message': '不支持的导出格式'})
+    if export_format == 'xlsx' and Workbook is None:
+        return jsonify({'success': False, 'message': '未安装 openpyxl，无法导出 XLSX'})
+    
+    branch = current_branch()
+    conn = get_db_connection(branch)
+    # 非缓冲游标：结果随取随读，不在客户端缓存整个结果集
+    cursor = conn.cursor(buffered=False)
+    finished = []
+    
+    def chunks():
+        yield from iter_chunks(cursor)
+        finished.append(True)
+    
+    def close():
+        if not finished:
+            # 客户端中途断开：关闭连接时驱动会把剩余结果全部读完再丢弃，先从另一个连接终止查询
+            try:
+                kill_query(branch, conn.connection_id)
+            except mysql.connector.Error:
+                pass  # 查询已结束
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            pass  # 查询被终止或仍有未读结果
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+    
+    try:
+        cursor.execute(sql, params)
+    except Exception as e:
+        finished.append(True)  # 没有正在执行的查询，无需终止
+        close()
+        return jsonify({'success': False, 'message': str(e)})
+    
+    if export_format == 'xlsx':
+        body = xlsx_stream(header, chunks(), filename)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body = csv_stream(header, chunks())
+        mimetype = 'text/csv'
+    
+    response = Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': 'attachment; filename=%s_%s.%s' % (
+                filename, date.today().strftime('%Y%m%d'), export_format),
+            'X-Accel-Buffering': 'no'
+        }
+    )
+    response.call_on_close(close)
+    return response
+
+@app.route('/api/export/borrow_records', methods=['GET'])
+@admin_required
+def export_borrow_records():
+    """导出借阅记录，可按读者、书籍、状态、借书日期范围过滤"""
+    conditions = []
+    params = []
+    
+    reader_id = request.args.get('reader_id', type=int)
+    book_id = request.args.get('book_id', type=int)
+    status = request.args.get('status')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    
+    if reader_id:
+        conditions.append("b.reader_id = %s")
+        params.append(reader_id)
+    if book_id:
+        conditions.append("b.book_id = %s")
+        params.append(book_id)
+    if status:
+        conditions.append("b.status = %s")
+        params.append(status)
+    if start_date:
+        conditions.append("b.borrow_date >= %s")
+        params.append(start_date)
+    if end_date:
+        conditions.append("b.borrow_date <= %s")
+        params.append(end_date)
+    
+    where_clause = "WHERE " + " AND ".join(conditions) if conditions else ""
+    
+    # 按主键顺序输出，无需排序即可边扫边发
+    return stream_export(f"""
+        SELECT b.borrow_id, b.reader_id, r.name as reader_name, b.book_id, bk.book_name,
+               b.borrow_date, b.return_date, b.actual_return_date, b.status
+        FROM borrow b
+        JOIN reader r ON b.reader_id = r.reader_id
+        JOIN book bk ON b.book_id = bk.book_id
+        {where_clause}
+        ORDER BY b.borrow_id
+    """, params,
+        ['borrow_id', 'reader_id', 'reader_name', 'book_id', 'book_name',
+         'borrow_date', 'return_date', 'actual_return_date', 'status'],
+        'borrow_records')
+
+@app.route('/api/export/reader_activity', methods=['GET'])
+@admin_required
+def export_reader_activity():
+    """导出读者借阅活跃度报表，可按性别、最少借阅次数过滤"""
+    conditions = []
+    params = []
+    
+    gender = request.args.get('gender')
+    min_borrow = request.args.get('min_borrow', type=int)
+    
+    if gender:
+        conditions.append("r.gender = %s")
+        params.append(gender)
+    
+    where_clause = "WHERE " + " AND ".join(conditions) if conditions else ""
+    having_clause = ""
+    if min_borrow:
+        having_clause = "HAVING COUNT(br.borrow_id) >= %s"
+        params.append(min_borrow)
+    
+    return stream_export(f"""
+        SELECT 
+            r.reader_id,
+            r.name,
+            r.gender,
+            COUNT(br.borrow_id) as total_borrow,
+            COUNT(CASE WHEN br.actual_return_date IS NULL THEN 1 END) as current_borrow,
+            MIN(br.borrow_date) as first_borrow_date,
+            MAX(br.borrow_date) as latest_borrow_date
+        FROM reader r
+        LEFT JOIN borrow br ON r.reader_id = br.reader_id
+        {where_clause}
+        GROUP BY r.reader_id, r.name, r.gender
+        {having_clause}
+        ORDER BY r.reader_id
+    """, params,
+        ['reader_id', 'name', 'gender', 'total_borrow', 'current_borrow',
+         'first_borrow_date', 'latest_borrow_date'],
+        'reader_activity')
+
 # ==================== AI/LLM集成功能（可选） ====================
 
 @app.route('/api/recommend/books', methods=['GET'])
@@ -689,6 +1334,11 @@ def recommend_books():
         
         history = cursor.fetchall()
         
+        branch_state = warm_states[current_branch()]
+        if not history and branch_state.ready.is_set():
+            # 没有借阅历史时直接使用内存中的热度排行
+            return jsonify({'success': True, 'data': branch_state.state.popular_books(10)})
+        
         if not history:
             # 如果没有借阅历史，推荐热门书籍
             cursor.execute("""
@@ -826,4 +1476,8 @@ def similar_books():
         conn.close()
 
 if __name__ == '__main__':
+    for manager in warm_states.values():
+        manager.ensure_started()
+    for exporter in snapshot_exporters.values():
+        exporter.start_auto_refresh(ANALYTICS_REFRESH_INTERVAL, ANALYTICS_FULL_EXPORT_INTERVAL)
     app.run(debug=True, port=5000)
@@ -0,0 +1,363 @@
+"""内存派生状态的热启动快照
+
+CatalogState 在内存中维护由 book / borrow 派生的数据：书籍检索结构、借阅热度排行、分类查找表。
+WarmStateManager 负责它的生命周期：
+    1. 启动时通过 mmap 读取本地快照文件（带格式版本号和事件日志高水位 seq）；
+    2. 没有可用快照时才从数据库全量重建；
+    3. 之后只回放 event_outbox 中高水位之后的事件，并定期把状态写回快照文件；
+    4. 回放出错或运行满 reconcile_interval 后从数据库全量重建一次，修正累积的偏差。
+
+快照文件格式：
+    magic(4) | 格式版本(uint32) | 高水位 seq(uint64) | 数据长度(uint64) | pickle 数据
+"""
+
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+
+from outbox import OutboxConsumer
+
+SNAPSHOT_MAGIC = b'LCST'
+STATE_VERSION = 1
+HEADER = struct.Struct('<4sIQQ')
+
+BOOK_FIELDS = ('book_name', 'author', 'publisher', 'category_id', 'category_name')
+GAP_WINDOW = 1000   # 重建时检查高水位之下多少个序号中尚未提交的空洞
+MAX_FAILURES = 5    # 连续失败多少次后撤销就绪状态，请求回退到数据库查询
+# 遇到序号空洞只短暂等待：跳过的序号由消费者重查，晚提交的事件仍会补充应用，
+# 不必为一个可能已回滚的事务让检索、热度排行停止更新
+GAP_TIMEOUT = 2.0
+
+logger = logging.getLogger(__name__)
+
+
+def _int(value):
+    """事件中的数值字段转为 int，无法转换时抛出 ValueError"""
+    if value is None or isinstance(value, bool):
+        raise ValueError('无效的数值：%r' % (value,))
+    return int(value)
+
+
+class CatalogState:
+    """由 book / borrow 派生的内存状态"""
+
+    def __init__(self, books=None, categories=None, borrow_counts=None, high_water_mark=0, pending=None):
+        self.books = books or {}                  # book_id -> 书籍信息（与 list_books 返回字段一致）
+        self.categories = categories or {}        # category_name -> category_id
+        self.borrow_counts = borrow_counts or {}  # book_id -> 累计借阅次数
+        self.high_water_mark = high_water_mark    # 已应用的最大事件序号
+        self.pending = pending or {}              # 高水位之下尚未看到的序号 -> 记录时间，由消费者重查
+        self.failed_events = 0
+        self.needs_reconcile = False              # 有事件应用失败，状态可能已偏离数据库
+        self._lock = threading.Lock()
+
+    @classmethod
+    def rebuild(cls, conn):
+        """从数据库全量重建（在一致性快照事务中读取，高水位与表数据对应同一时刻）
+
+        序号按分配顺序而不是提交顺序可见，快照时刻高水位之下可能还有未提交的事务。
+        这些空洞记入 pending，由消费者重查，之后提交的事件仍会补充应用。
+        """
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM event_outbox")
+            high_water_mark = cursor.fetchone()['seq']
+
+            low = max(0, high_water_mark - GAP_WINDOW)
+            cursor.execute("SELECT seq FROM event_outbox WHERE seq > %s", (low,))
+            present = {row['seq'] for row in cursor.fetchall()}
+            now = time.time()
+            pending = {seq: now for seq in range(low + 1, high_water_mark + 1) if seq not in present}
+
+            cursor.execute("""
+                SELECT b.*, c.category_name
+                FROM book b
+                LEFT JOIN category c ON b.category_id = c.category_id
+                ORDER BY b.book_id
+            """)
+            books = {row['book_id']: row for row in cursor.fetchall()}
+
+            cursor.execute("SELECT category_id, category_name FROM category")
+            categories = {row['category_name']: row['category_id'] for row in cursor.fetchall()}
+
+            cursor.execute("SELECT book_id, COUNT(*) AS borrow_count FROM borrow GROUP BY book_id")
+            borrow_counts = {row['book_id']: row['borrow_count'] for row in cursor.fetchall()}
+
+            conn.commit()
+        finally:
+            cursor.close()
+        return cls(books, categories, borrow_counts, high_water_mark, pending)
+
+    @classmethod
+    def load(cls, path):
+        """通过 mmap 读取快照文件，文件不存在或版本不符返回 None"""
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if len(mm) < HEADER.size:
+                    return None
+                magic, version, high_water_mark, length = HEADER.unpack_from(mm, 0)
+                if magic != SNAPSHOT_MAGIC or version != STATE_VERSION or len(mm) < HEADER.size + length:
+                    return None
+                with memoryview(mm)[HEADER.size:HEADER.size + length] as data:
+                    payload = pickle.loads(data)
+        except (OSError, ValueError, pickle.UnpicklingError):
+            return None
+        return cls(payload['books'], payload['categories'], payload['borrow_counts'], high_water_mark,
+                   payload.get('pending'))
+
+    def save(self, path):
+        """写入快照文件（先写临时文件再原子替换）"""
+        with self._lock:
+            data = pickle.dumps({
+                'books': self.books,
+                'categories': self.categories,
+                'borrow_counts': self.borrow_counts,
+                'pending': self.pending,
+            }, protocol=pickle.HIGHEST_PROTOCOL)
+            high_water_mark = self.high_water_mark
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(SNAPSHOT_MAGIC, STATE_VERSION, high_water_mark, len(data)))
+            f.write(data)
+        os.replace(tmp_path, path)
+        return high_water_mark
+
+    def apply(self, events):
+        """按顺序应用事件日志
+
+        单条事件应用失败时记录日志并跳过，高水位照常推进，同时标记需要全量重建；
+        消费者补发的迟到事件（late）序号低于高水位，也要应用。
+        """
+        with self._lock:
+            for event in events:
+                late = event.get('late')
+                if event['seq'] <= self.high_water_mark and not late:
+                    continue
+                try:
+                    self._apply(event['event_type'], event['entity_id'], event['payload'])
+                except Exception:
+                    logger.exception('事件 %s（%s）应用失败，已跳过', event['seq'], event['event_type'])
+                    self.failed_events += 1
+                    self.needs_reconcile = True
+                if not late:
+                    self.high_water_mark = event['seq']
+
+    def _apply(self, event_type, entity_id, payload):
+        if event_type == 'book_added':
+            total_count = _int(payload.get('total_count'))
+            self.books[entity_id] = {
+                'book_id': entity_id,
+                'book_name': payload.get('book_name'),
+                'author': payload.get('author'),
+                'publisher': payload.get('publisher'),
+                'category_id': payload.get('category_id'),
+                'total_count': total_count,
+                'available_count': total_count,
+                'category_name': payload.get('category_name'),
+            }
+            self._add_category(payload)
+        elif event_type == 'book_restocked':
+            count = _int(payload.get('count'))
+            book = self.books.get(entity_id)
+            if book:
+                book['total_count'] += count
+                book['available_count'] += count
+        elif event_type == 'book_updated':
+            book = self.books.get(entity_id)
+            if book:
+                book.update({field: payload.get(field) for field in BOOK_FIELDS})
+            self._add_category(payload)
+        elif event_type == 'book_deleted':
+            self.books.pop(entity_id, None)
+            self.borrow_counts.pop(entity_id, None)
+        elif event_type == 'book_borrowed':
+            book_id = _int(payload.get('book_id'))
+            self.borrow_counts[book_id] = self.borrow_counts.get(book_id, 0) + 1
+            book = self.books.get(book_id)
+            if book and book['available_count'] > 0:
+                book['available_count'] -= 1
+        elif event_type == 'book_returned':
+            book = self.books.get(_int(payload.get('book_id')))
+            if book:
+                book['available_count'] += 1
+
+    def _add_category(self, payload):
+        if payload.get('category_name') is not None:
+            self.categories[payload['category_name']] = payload.get('category_id')
+
+    def search(self, keyword):
+        """按书名、作者、出版社模糊搜索（不区分大小写）"""
+        keyword = keyword.casefold()
+        with self._lock:
+            return [
+                dict(book) for book_id, book in sorted(self.books.items())
+                if any(keyword in (book[field] or '').casefold() for field in ('book_name', 'author', 'publisher'))
+            ]
+
+    def search_by_author(self, author):
+        """按作者模糊搜索"""
+        author = author.casefold()
+        with self._lock:
+            return [
+                dict(book) for book_id, book in sorted(self.books.items())
+                if author in (book['author'] or '').casefold()
+            ]
+
+    def popular_books(self, limit=10, available_only=True):
+        """借阅热度排行"""
+        with self._lock:
+            books = [book for book in self.books.values() if not available_only or book['available_count'] > 0]
+            books.sort(key=lambda book: self.borrow_counts.get(book['book_id'], 0), reverse=True)
+            return [dict(book) for book in books[:limit]]
+
+    def category_id(self, category_name):
+        """分类名称 -> 分类ID"""
+        with self._lock:
+            return self.categories.get(category_name)
+
+
+class WarmStateManager:
+    """在后台线程中完成热启动，并持续回放事件日志"""
+
+    def __init__(self, path, connect, sync_interval=1.0, save_interval=60.0, reconcile_interval=6 * 3600.0):
+        self.path = path
+        self.connect = connect
+        self.sync_interval = sync_interval
+        self.save_interval = save_interval
+        self.reconcile_interval = reconcile_interval
+        self.state = None
+        self.ready = threading.Event()
+        self.warmup = {}
+        self.error = None
+        self.failures = 0
+        self.reconciled_at = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def ensure_started(self):
+        """首次调用时启动后台线程（多次调用无副作用）"""
+        if self._started:
+            return
+        with self._start_lock:
+            if not self._started:
+                threading.Thread(target=self._run, name='warm-state', daemon=True).start()
+                self._started = True
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        return {
+            'ready': self.ready.is_set(),
+            'high_water_mark': self.state.high_water_mark if self.state else None,
+            'books': len(self.state.books) if self.state else 0,
+            'pending_seqs': len(self.state.pending) if self.state else 0,
+            'failed_events': self.state.failed_events if self.state else 0,
+            'warmup': self.warmup,
+            'error': self.error,
+            'failures': self.failures,
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._warm_up()
+                break
+            except Exception as e:
+                self.error = str(e)
+                self._stop.wait(self.sync_interval * 5)
+
+        consumer = self._consumer(self.state)
+        last_save = time.monotonic()
+        saved_mark = self.state.high_water_mark if self.state else 0
+        while not self._stop.is_set():
+            try:
+                if (self.state.needs_reconcile
+                        or time.monotonic() - self.reconciled_at >= self.reconcile_interval):
+                    self._reconcile()
+                    consumer = self._consumer(self.state)
+                    saved_mark = self.state.high_water_mark
+                    last_save = time.monotonic()
+
+                consumer.position = self.state.high_water_mark
+                events = consumer.poll()
+                if events:
+                    self.state.apply(events)
+                if self.state.high_water_mark != saved_mark and time.monotonic() - last_save >= self.save_interval:
+                    saved_mark = self.state.save(self.path)
+                    last_save = time.monotonic()
+                self.error = None
+                self.failures = 0
+                self.ready.set()
+                if events:
+                    continue
+            except Exception as e:
+                self.error = str(e)
+                self.failures += 1
+                # 持续追不上事件日志时内存状态会越来越旧，撤销就绪让请求回退到数据库
+                if self.failures >= MAX_FAILURES:
+                    self.ready.clear()
+            self._stop.wait(self.sync_interval)
+
+    def _consumer(self, state, batch_size=500):
+        consumer = OutboxConsumer('warm-state', self.connect, batch_size=batch_size, gap_timeout=GAP_TIMEOUT)
+        consumer.position = state.high_water_mark
+        consumer.pending = state.pending  # 与状态共用同一份待重查序号，随快照一起保存
+        return consumer
+
+    def _catch_up(self, state):
+        """回放高水位之后的事件直到追平，返回回放的事件数"""
+        consumer = self._consumer(state, batch_size=5000)
+        replayed = 0
+        while True:
+            events = consumer.poll()
+            if not events:
+                return replayed
+            state.apply(events)
+            replayed += len(events)
+
+    def _rebuild(self):
+        conn = self.connect()
+        try:
+            return CatalogState.rebuild(conn)
+        finally:
+            conn.close()
+
+    def _reconcile(self):
+        """从数据库全量重建并追平后替换当前状态"""
+        state = self._rebuild()
+        self._catch_up(state)
+        self.state = state
+        state.save(self.path)
+        self.reconciled_at = time.monotonic()
+
+    def _warm_up(self):
+        start = time.monotonic()
+        state = CatalogState.load(self.path)
+        source = 'snapshot'
+        if state is None:
+            state = self._rebuild()
+            state.save(self.path)
+            source = 'rebuild'
+        loaded_at = time.monotonic()
+
+        # 回放高水位之后的事件，追平后才标记就绪
+        replayed = self._catch_up(state)
+
+        self.state = state
+        self.reconciled_at = loaded_at
+        self.warmup = {
+            'source': source,
+            'load_ms': round((loaded_at - start) * 1000, 1),
+            'replay_ms': round((time.monotonic() - loaded_at) * 1000, 1),
+            'replayed_events': replayed,
+        }
+        self.error = None
+        self.ready.set()
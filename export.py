@@ -0,0 +1,61 @@
+"""流式导出
+
+从非缓冲游标按固定大小分块取数，边取边写出 CSV（或 XLSX），内存占用与结果集大小无关。
+XLSX 依赖可选的 openpyxl：以 write_only 模式逐行写入临时文件后再分块发送，
+由于 xlsx 是 zip 格式，需要整个文件写完才能开始发送；CSV 在取到第一块数据后即开始输出。
+"""
+
+import csv
+import io
+import tempfile
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+EXPORT_CHUNK_SIZE = 1000
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(cursor, chunk_size=EXPORT_CHUNK_SIZE):
+    """按固定大小分块读取游标结果"""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def csv_stream(header, chunks):
+    """逐块生成 CSV 文本（带 BOM，Excel 打开中文不乱码）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    yield buffer.getvalue()
+
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate(0)
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+def xlsx_stream(header, chunks, title):
+    """以 write_only 模式写入临时文件，完成后分块输出"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=title)
+    sheet.append(header)
+    for rows in chunks:
+        for row in rows:
+            sheet.append(list(row))
+
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        while True:
+            data = f.read(FILE_CHUNK_SIZE)
+            if not data:
+                return
+            yield data
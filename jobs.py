@@ -0,0 +1,386 @@
+"""后台报表任务
+
+耗时的统计查询提交到本地任务队列，由工作线程执行，HTTP 请求只负责提交并立即返回任务ID。
+结果连同完成时间保存在本地目录中，新鲜期内的重复请求直接读取已保存的结果。
+任务状态同样保存在结果目录中，同一台机器上的多个 worker 进程都能查询、复用和取消任务：
+    <result_dir>/<报表>-<参数摘要>.pickle   报表结果
+    <result_dir>/jobs/<job_id>.json          任务状态（进度、所属进程、正在使用的数据库连接）
+    <result_dir>/jobs/<job_id>.cancel        取消标记
+    <result_dir>/active/<报表>-<参数摘要>     未结束任务的占位文件，相同请求复用同一个任务
+取消时写入取消标记，并对任务登记的数据库连接执行 KILL QUERY；执行任务的进程在每个分片开始前检查标记。
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_FINISHED_JOBS = 200
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+UNFINISHED = ('queued', 'running')
+
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    """任务已被取消"""
+
+
+def current_job():
+    """当前线程正在执行的任务，不在任务中返回 None"""
+    return getattr(_local, 'job', None)
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        return True  # Windows 上 os.kill 会结束进程，无法用来探测
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ReportJob:
+    """在本进程中执行的一次报表任务，状态变化时写回状态文件"""
+
+    def __init__(self, queue, report, params, key):
+        self.queue = queue
+        self.id = uuid.uuid4().hex
+        self.report = report
+        self.params = params
+        self.key = key
+        self.status = 'queued'
+        self.done_steps = 0
+        self.total_steps = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def bind(self, fn):
+        """包装 fn，使其在其他线程（如分片线程池）中执行时仍归属于本任务"""
+        def wrapper(*args, **kwargs):
+            previous = current_job()
+            _local.job = self
+            try:
+                self.check_cancelled()
+                return fn(*args, **kwargs)
+            finally:
+                _local.job = previous
+        return wrapper
+
+    def set_total(self, total_steps):
+        with self._lock:
+            self.total_steps = total_steps
+            self._save()
+
+    def advance(self, steps=1):
+        with self._lock:
+            self.done_steps += steps
+            self._save()
+
+    def track_connection(self, branch, connection_id):
+        """登记任务使用的数据库连接，取消时（可能在其他进程中）据此终止正在执行的查询"""
+        with self._lock:
+            self._connections.append([branch, connection_id])
+            self._save()
+
+    def check_cancelled(self):
+        if not self._cancelled.is_set() and os.path.exists(self.queue._cancel_path(self.id)):
+            self._cancelled.set()
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self._save()
+
+    def _save(self):
+        self.queue._write_state({
+            'job_id': self.id,
+            'report': self.report,
+            'params': self.params,
+            'key': self.key,
+            'status': self.status,
+            'done_steps': self.done_steps,
+            'total_steps': self.total_steps,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'pid': os.getpid(),
+            'connections': self._connections,
+        })
+
+
+class JobQueue:
+    """本地报表任务队列"""
+
+    def __init__(self, result_dir, kill_query, max_workers=2, freshness=300):
+        self.result_dir = result_dir
+        self.kill_query = kill_query  # kill_query(branch, connection_id)
+        self.freshness = freshness    # 结果新鲜期（秒）
+        self.reports = {}
+        self._running = {}            # 本进程中未结束的任务
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='report')
+
+    @property
+    def job_dir(self):
+        return os.path.join(self.result_dir, 'jobs')
+
+    @property
+    def active_dir(self):
+        return os.path.join(self.result_dir, 'active')
+
+    def register(self, name, fn):
+        """注册报表：fn(job, params) 返回结果"""
+        self.reports[name] = fn
+
+    def _key(self, report, params):
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return '%s-%s' % (report, digest)
+
+    def _path(self, key):
+        return os.path.join(self.result_dir, key + '.pickle')
+
+    def _state_path(self, job_id):
+        return os.path.join(self.job_dir, job_id + '.json')
+
+    def _cancel_path(self, job_id):
+        return os.path.join(self.job_dir, job_id + '.cancel')
+
+    def _active_path(self, key):
+        return os.path.join(self.active_dir, key)
+
+    def _load_result(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def stored_result(self, report, params, max_age=None):
+        """读取已保存的结果，超过新鲜期或不存在返回 None；返回 (结果, 完成时间)"""
+        max_age = self.freshness if max_age is None else max_age
+        stored = self._load_result(self._key(report, params))
+        if stored is None or time.time() - stored['finished_at'] > max_age:
+            return None
+        return stored['result'], stored['finished_at']
+
+    def submit(self, report, params, force=False):
+        """提交报表任务，返回 (任务信息, None)；新鲜期内已有结果时返回 (None, 已保存的结果)
+
+        任意进程中已有相同报表和参数的未结束任务时，直接返回该任务。
+        """
+        if report not in self.reports:
+            raise KeyError(report)
+        if not force:
+            stored = self.stored_result(report, params)
+            if stored is not None:
+                return None, stored
+
+        key = self._key(report, params)
+        os.makedirs(self.active_dir, exist_ok=True)
+        job = ReportJob(self, report, params, key)
+        job.update()
+        # 占位文件先写好内容再硬链接到位：链接已存在时失败，其他进程不会读到空的占位文件
+        tmp_path = os.path.join(self.active_dir, '.%s.tmp' % job.id)
+        with open(tmp_path, 'w') as f:
+            f.write(job.id)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, self._active_path(key))
+                except FileExistsError:
+                    existing = self._active_job(key)
+                    if existing is None:
+                        continue  # 占位文件已过期并被清理，重新占位
+                    self._remove(self._state_path(job.id))
+                    return self._view(existing), None
+                break
+            else:
+                self._remove(self._state_path(job.id))
+                raise RuntimeError('报表任务提交冲突，请重试')
+        finally:
+            self._remove(tmp_path)
+
+        with self._lock:
+            self._running[job.id] = job
+        self._evict()
+        self._executor.submit(self._run, job)
+        return self._view(self._read_state(job.id)), None
+
+    def _active_job(self, key):
+        """占位文件对应的未结束任务；任务已结束或所属进程已退出时清理占位文件并返回 None"""
+        try:
+            with open(self._active_path(key)) as f:
+                job_id = f.read().strip()
+        except OSError:
+            return None
+        state = self._read_state(job_id) if JOB_ID_PATTERN.match(job_id) else None
+        if state is not None and state['status'] in UNFINISHED:
+            return state
+        self._remove(self._active_path(key))
+        return None
+
+    def get(self, job_id, include_result=False):
+        """任务信息，任务不存在返回 None"""
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        state = self._read_state(job_id)
+        return self._view(state, include_result) if state else None
+
+    def list(self):
+        """最近的任务（按创建时间排序）"""
+        return [self._view(state) for state in self._states()]
+
+    def cancel(self, job_id):
+        """取消任务：写入取消标记，并终止任务正在执行的查询"""
+        if not JOB_ID_PATTERN.match(job_id):
+            return False
+        state = self._read_state(job_id)
+        if state is None or state['status'] not in UNFINISHED:
+            return False
+        with open(self._cancel_path(job_id), 'w'):
+            pass
+        with self._lock:
+            job = self._running.get(job_id)
+        if job is not None:
+            job._cancelled.set()
+        for branch, connection_id in state['connections']:
+            try:
+                self.kill_query(branch, connection_id)
+            except Exception:
+                pass  # 连接已关闭或查询已结束
+        return True
+
+    def _run(self, job):
+        try:
+            job.check_cancelled()
+        except JobCancelled:
+            self._finish(job, 'cancelled')
+            return
+
+        job.update(status='running', started_at=time.time())
+        try:
+            result = job.bind(self.reports[job.report])(job, job.params)
+            job.check_cancelled()
+        except JobCancelled:
+            self._finish(job, 'cancelled')
+            return
+        except Exception as e:
+            if job._cancelled.is_set() or os.path.exists(self._cancel_path(job.id)):
+                # KILL QUERY 使查询以异常结束
+                self._finish(job, 'cancelled')
+            else:
+                self._finish(job, 'failed', str(e))
+            return
+
+        job.result = result
+        job.finished_at = time.time()
+        try:
+            self._store(job)
+        except OSError as e:
+            self._finish(job, 'failed', '结果保存失败：%s' % e)
+            return
+        self._finish(job, 'done')
+
+    def _finish(self, job, status, error=None):
+        job.update(status=status, error=error, finished_at=job.finished_at or time.time())
+        job.result = None  # 结果已保存到文件，不再占用内存
+        with self._lock:
+            self._running.pop(job.id, None)
+        self._remove(self._cancel_path(job.id))
+        try:
+            with open(self._active_path(job.key)) as f:
+                owner = f.read().strip()
+        except OSError:
+            return
+        if owner == job.id:
+            self._remove(self._active_path(job.key))
+
+    def _store(self, job):
+        os.makedirs(self.result_dir, exist_ok=True)
+        path = self._path(job.key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'report': job.report,
+                'params': job.params,
+                'finished_at': job.finished_at,
+                'result': job.result,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _write_state(self, state):
+        os.makedirs(self.job_dir, exist_ok=True)
+        path = self._state_path(state['job_id'])
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _read_state(self, job_id):
+        """读取任务状态；所属进程已退出的未结束任务标记为失败"""
+        try:
+            with open(self._state_path(job_id), encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state['status'] in UNFINISHED and not _pid_alive(state['pid']):
+            state.update(status='failed', error='任务所在进程已退出', finished_at=time.time())
+            self._write_state(state)
+        return state
+
+    def _states(self):
+        try:
+            names = os.listdir(self.job_dir)
+        except OSError:
+            return []
+        states = [self._read_state(name[:-5]) for name in names
+                  if name.endswith('.json') and JOB_ID_PATTERN.match(name[:-5])]
+        return sorted((state for state in states if state), key=lambda state: state['created_at'])
+
+    def _view(self, state, include_result=False):
+        data = {
+            'job_id': state['job_id'],
+            'report': state['report'],
+            'params': state['params'],
+            'status': state['status'],
+            'progress': round(state['done_steps'] / state['total_steps'], 4) if state['total_steps'] else 0,
+            'created_at': state['created_at'],
+            'started_at': state['started_at'],
+            'finished_at': state['finished_at'],
+            'error': state['error'],
+        }
+        if include_result and state['status'] == 'done':
+            stored = self._load_result(state['key'])
+            data['result'] = stored['result'] if stored else None
+        return data
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """只保留最近的已结束任务"""
+        finished = [state for state in self._states() if state['status'] not in UNFINISHED]
+        for state in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            self._remove(self._state_path(state['job_id']))
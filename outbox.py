@@ -0,0 +1,191 @@
+"""事务性事件日志（outbox）
+
+各写操作在同一事务中向 event_outbox 追加一条事件，下游（搜索索引、缓存、计数、分析快照等）
+通过 OutboxConsumer 按序号分批读取并记录检查点，只处理增量变化，无需反复扫描全表。
+
+事件类型及 payload：
+    reader_registered  entity_id=reader_id  {name, gender, phone}
+    book_added         entity_id=book_id    {book_name, author, publisher, category_id, category_name, total_count}
+    book_restocked     entity_id=book_id    {count}
+    book_updated       entity_id=book_id    {book_name, author, publisher, category_id, category_name}
+    book_deleted       entity_id=book_id    {}
+    book_borrowed      entity_id=borrow_id  {reader_id, book_id, borrow_date, return_date}
+    book_returned      entity_id=borrow_id  {book_id, actual_return_date}
+"""
+
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_PENDING = 1000      # 最多同时重查的跳过序号数
+RECHECK_INTERVAL = 5.0  # 两次重查跳过序号的最短间隔（秒）
+
+
+def append_event(cursor, event_type, entity_id, payload=None):
+    """在当前事务中追加一条事件（由调用方提交事务）"""
+    cursor.execute(
+        "INSERT INTO event_outbox (event_type, entity_id, payload) VALUES (%s, %s, %s)",
+        (event_type, entity_id, json.dumps(payload or {}, ensure_ascii=False, default=str))
+    )
+
+
+def _decode(row):
+    payload = row['payload']
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode('utf-8')
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+    row['payload'] = payload or {}
+    return row
+
+
+def fetch_events(conn, after_seq, limit):
+    """读取序号大于 after_seq 的事件"""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT seq, event_type, entity_id, payload, create_time
+            FROM event_outbox
+            WHERE seq > %s
+            ORDER BY seq
+            LIMIT %s
+        """, (after_seq, limit))
+        return [_decode(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def fetch_events_by_seq(conn, seqs):
+    """按序号读取指定事件（用于重查此前跳过的空洞）"""
+    if not seqs:
+        return []
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT seq, event_type, entity_id, payload, create_time
+            FROM event_outbox
+            WHERE seq IN (%s)
+            ORDER BY seq
+        """ % ", ".join(["%s"] * len(seqs)), tuple(seqs))
+        return [_decode(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+class OutboxConsumer:
+    """按序号分批消费事件，检查点保存在 outbox_checkpoint 表中
+
+    自增序号按分配顺序而不是提交顺序可见：一个较小序号的事务可能晚于较大序号提交，
+    事务回滚也会留下永久空洞。遇到空洞时先停在空洞之前，空洞持续超过 gap_timeout 秒才跳过，
+    默认 60 秒，明显长于锁等待超时等常见的事务持续时间。
+    跳过的序号记入 pending，在 pending_retention 秒内定期重查；之后才提交的事件仍会补发给
+    调用方，并带有 late=True 标记（序号小于当前位置，调用方不能按序号去重丢弃）。
+    """
+
+    def __init__(self, name, connect, batch_size=500, gap_timeout=60.0, pending_retention=3600.0):
+        self.name = name
+        self.connect = connect
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.pending_retention = pending_retention
+        self.position = None
+        self.pending = {}        # 已跳过、仍在重查的序号 -> 跳过时间（time.time()）
+        self._gaps = {}
+        self._rechecked_at = 0.0
+
+    def load_checkpoint(self, conn):
+        """读取检查点，返回 (last_seq, pending)"""
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT last_seq, pending FROM outbox_checkpoint WHERE consumer = %s", (self.name,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        if not row:
+            return 0, {}
+        pending = row[1]
+        if isinstance(pending, (bytes, bytearray)):
+            pending = pending.decode('utf-8')
+        if isinstance(pending, str):
+            pending = json.loads(pending)
+        return row[0], {int(seq): skipped_at for seq, skipped_at in (pending or {}).items()}
+
+    def poll(self):
+        """读取下一批事件并推进内存中的位置；处理完成后调用 commit 持久化检查点"""
+        conn = self.connect()
+        try:
+            if self.position is None:
+                self.position, self.pending = self.load_checkpoint(conn)
+            rows = fetch_events(conn, self.position, self.batch_size)
+            late = self._recheck(conn)
+        finally:
+            conn.close()
+
+        events = []
+        expected = self.position + 1
+        for event in rows:
+            if event['seq'] != expected:
+                first_seen = self._gaps.setdefault(expected, time.monotonic())
+                if time.monotonic() - first_seen < self.gap_timeout:
+                    break
+                del self._gaps[expected]
+                self._skip(expected, event['seq'])
+            events.append(event)
+            expected = event['seq'] + 1
+
+        if events:
+            self.position = events[-1]['seq']
+        return late + events
+
+    def _skip(self, first_seq, next_seq):
+        """跳过 [first_seq, next_seq) 的空洞，记入 pending 以便之后重查"""
+        logger.warning('outbox 消费者 %s 跳过序号 %d-%d', self.name, first_seq, next_seq - 1)
+        now = time.time()
+        for seq in range(first_seq, next_seq):
+            self.pending[seq] = now
+        if len(self.pending) > MAX_PENDING:
+            for seq in sorted(self.pending, key=self.pending.get)[:len(self.pending) - MAX_PENDING]:
+                del self.pending[seq]
+
+    def _recheck(self, conn):
+        """重查跳过的序号，返回其间已提交的事件"""
+        if not self.pending or time.monotonic() - self._rechecked_at < RECHECK_INTERVAL:
+            return []
+        self._rechecked_at = time.monotonic()
+        now = time.time()
+        for seq, skipped_at in list(self.pending.items()):
+            if now - skipped_at > self.pending_retention:
+                del self.pending[seq]
+
+        late = fetch_events_by_seq(conn, sorted(self.pending))
+        for event in late:
+            del self.pending[event['seq']]
+            event['late'] = True
+        return late
+
+    def commit(self, seq=None):
+        """持久化检查点，默认提交到当前位置"""
+        seq = self.position if seq is None else seq
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO outbox_checkpoint (consumer, last_seq, pending) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE last_seq = VALUES(last_seq), pending = VALUES(pending)
+            """, (self.name, seq, json.dumps(self.pending)))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def run(self, handler, stop_event, idle_interval=1.0):
+        """持续消费：每批事件交给 handler 处理后提交检查点，直到 stop_event 被设置"""
+        while not stop_event.is_set():
+            events = self.poll()
+            if events:
+                handler(events)
+                self.commit()
+            else:
+                stop_event.wait(idle_interval)
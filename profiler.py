@@ -0,0 +1,272 @@
+"""按需采样分析器
+
+管理员可针对某个路由（或按百分比抽取请求）在限定时间内开启栈采样。后台线程按固定间隔
+通过 sys._current_frames() 读取被选中请求所在线程的调用栈，汇总为折叠栈（collapsed stack，
+可直接交给 flamegraph.pl / speedscope 生成火焰图），并按耗时去向分类统计：
+    db_wait   等待数据库返回（纯 Python 实现的网络读；C 扩展停在 cmd_query / get_rows 中）
+    protocol  mysql.connector 协议解析与类型转换
+    cursor    游标取数与行字典构建
+    jsonify   JSON 序列化
+    app       其他应用代码
+只采样被选中的线程，且时长、采样间隔、栈数量都有上限，可以在生产环境短时间开启。
+采样只能估算耗时分布，数据库耗时另外通过包装连接的 cmd_query / get_rows / get_row 直接计时，
+对纯 Python 实现和 C 扩展都准确。
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from flask import g, request
+
+MAX_DURATION = 600        # 单次采样最长秒数
+MIN_INTERVAL_MS = 5       # 最小采样间隔
+MAX_STACK_DEPTH = 128
+MAX_DISTINCT_STACKS = 20000
+
+_MYSQL_DIR = os.sep + os.path.join('mysql', 'connector') + os.sep
+# C 扩展的网络读与解析都在 C 代码中完成，采样时栈顶停在调用它的 Python 方法上
+_CEXT_DB_CALLS = ('cmd_query', 'get_rows', 'get_row')
+_TIMED_CALLS = ('cmd_query', 'get_rows', 'get_row')
+_JSON_DIRS = (os.sep + os.path.join('flask', 'json') + os.sep, os.sep + os.path.join('json', 'encoder.py'))
+
+
+def _classify(codes):
+    """从栈顶向下找到第一个可识别的帧，判断这次采样的耗时去向"""
+    for code in codes:
+        filename = code.co_filename
+        if _MYSQL_DIR in filename:
+            base = os.path.basename(filename)
+            if base == 'network.py' and 'recv' in code.co_name:
+                return 'db_wait'
+            if base == 'connection_cext.py' and code.co_name in _CEXT_DB_CALLS:
+                return 'db_wait'
+            if base.startswith('cursor'):
+                return 'cursor'
+            return 'protocol'
+        if any(part in filename for part in _JSON_DIRS):
+            return 'jsonify'
+    return 'app'
+
+
+def _route_stats():
+    return {'count': 0, 'wall_ms': 0.0, 'max_ms': 0.0, 'db_ms': 0.0, 'db_calls': 0}
+
+
+def _frame_name(code):
+    # 折叠栈以分号分隔，帧名中不能出现分号
+    return ('%s (%s)' % (code.co_name, os.path.basename(code.co_filename))).replace(';', ':')
+
+
+class SamplingProfiler:
+    """低开销的按路由栈采样"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._targets = {}     # 线程ID -> endpoint
+        self._owners = {}      # 分片工作线程ID -> 发起请求的线程ID
+        self._db_time = {}     # 请求线程ID -> [数据库耗时秒数, 调用次数]
+        self._in_db = set()    # 正在计时的线程（get_row 内部还会调用 get_rows，避免重复计时）
+        self.app = None
+        self._session = None
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.stacks = defaultdict(int)                          # 折叠栈 -> 采样次数
+        self.breakdown = defaultdict(lambda: defaultdict(int))  # endpoint -> 分类 -> 采样次数
+        self.requests = defaultdict(_route_stats)
+        self.samples = 0
+        self.dropped_stacks = 0
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def start(self, route=None, percent=100, duration=60, interval_ms=10):
+        """开启一次采样会话；已有会话在运行时返回 False，路由不存在时抛出 ValueError"""
+        if route and self.app is not None and route not in self.app.view_functions:
+            raise ValueError('未知的路由：%s' % route)
+        duration = max(1, min(float(duration), MAX_DURATION))
+        interval_ms = max(MIN_INTERVAL_MS, float(interval_ms))
+        with self._lock:
+            if self.active():
+                return False
+            self._reset()
+            self._stop.clear()
+            self._session = {
+                'route': route,
+                'percent': max(0.0, min(float(percent), 100.0)),
+                'duration': duration,
+                'interval_ms': interval_ms,
+                'started_at': time.time(),
+                'deadline': time.monotonic() + duration,
+                'running': True,
+            }
+        threading.Thread(target=self._sample_loop, args=(interval_ms / 1000,), name='profiler', daemon=True).start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def active(self):
+        return self._session is not None and self._session['running']
+
+    def bind(self, fn):
+        """包装 fn，使其在分片线程池中执行时仍归属于当前被采样的请求"""
+        owner = threading.get_ident()
+        endpoint = self._targets.get(owner)
+        if endpoint is None:
+            return fn
+
+        def wrapper(*args, **kwargs):
+            ident = threading.get_ident()
+            with self._lock:
+                self._targets[ident] = endpoint
+                self._owners[ident] = owner
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._targets.pop(ident, None)
+                    self._owners.pop(ident, None)
+        return wrapper
+
+    def instrument(self, conn):
+        """包装连接的查询与取数方法，为被采样的请求记录数据库耗时；没有采样会话时原样返回"""
+        if not self.active():
+            return conn
+        for name in _TIMED_CALLS:
+            method = getattr(conn, name, None)
+            if method is not None:
+                setattr(conn, name, self._timed(method))
+        return conn
+
+    def _timed(self, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            ident = threading.get_ident()
+            if ident not in self._targets or ident in self._in_db:
+                return method(*args, **kwargs)
+            self._in_db.add(ident)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self._in_db.discard(ident)
+                with self._lock:
+                    stats = self._db_time.get(self._owners.get(ident, ident))
+                    if stats is not None:
+                        stats[0] += elapsed
+                        stats[1] += 1
+        return wrapper
+
+    def _before_request(self):
+        session = self._session
+        if session is None or not session['running']:
+            return
+        if session['route'] and request.endpoint != session['route']:
+            return
+        if random.random() * 100 >= session['percent']:
+            return
+        g.profiler_start = time.perf_counter()
+        with self._lock:
+            self._targets[threading.get_ident()] = request.endpoint
+            self._db_time[threading.get_ident()] = [0.0, 0]
+
+    def _teardown_request(self, exc):
+        start = g.pop('profiler_start', None)
+        if start is None:
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            endpoint = self._targets.pop(threading.get_ident(), None)
+            db_seconds, db_calls = self._db_time.pop(threading.get_ident(), (0.0, 0))
+            if endpoint is not None and self.active():
+                stats = self.requests[endpoint]
+                stats['count'] += 1
+                stats['wall_ms'] += elapsed
+                stats['max_ms'] = max(stats['max_ms'], elapsed)
+                stats['db_ms'] += db_seconds * 1000
+                stats['db_calls'] += db_calls
+
+    def _sample_loop(self, interval):
+        session = self._session
+        while not self._stop.wait(interval) and time.monotonic() < session['deadline']:
+            with self._lock:
+                targets = dict(self._targets)
+            if not targets:
+                continue
+
+            frames = sys._current_frames()
+            for ident, endpoint in targets.items():
+                frame = frames.get(ident)
+                codes = []
+                while frame is not None and len(codes) < MAX_STACK_DEPTH:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                if not codes:
+                    continue
+
+                category = _classify(codes)
+                key = ';'.join([endpoint] + [_frame_name(code) for code in reversed(codes)])
+                with self._lock:
+                    self.samples += 1
+                    self.breakdown[endpoint][category] += 1
+                    if key in self.stacks or len(self.stacks) < MAX_DISTINCT_STACKS:
+                        self.stacks[key] += 1
+                    else:
+                        self.dropped_stacks += 1
+            del frames
+
+        with self._lock:
+            session['running'] = False
+            self._targets.clear()
+            self._owners.clear()
+            self._db_time.clear()
+
+    def collapsed(self):
+        """折叠栈文本，每行 "帧;帧;帧 次数"""
+        with self._lock:
+            return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+    def report(self):
+        """会话状态、各路由墙钟耗时与采样分类估算耗时"""
+        with self._lock:
+            session = self._session
+            if session is None:
+                return None
+            interval_ms = session['interval_ms']
+            routes = {}
+            for endpoint in set(self.requests) | set(self.breakdown):
+                stats = self.requests.get(endpoint) or _route_stats()
+                samples = self.breakdown.get(endpoint, {})
+                routes[endpoint] = {
+                    'requests': stats['count'],
+                    'wall_ms_total': round(stats['wall_ms'], 2),
+                    'wall_ms_avg': round(stats['wall_ms'] / stats['count'], 2) if stats['count'] else 0,
+                    'wall_ms_max': round(stats['max_ms'], 2),
+                    # 直接计时的数据库耗时（分片并行时为各分片耗时之和，可能超过墙钟时间）
+                    'db_ms_total': round(stats['db_ms'], 2),
+                    'db_ms_avg': round(stats['db_ms'] / stats['count'], 2) if stats['count'] else 0,
+                    'db_calls': stats['db_calls'],
+                    'sampled_ms': {category: round(count * interval_ms, 2) for category, count in samples.items()},
+                }
+            return {
+                'route': session['route'],
+                'percent': session['percent'],
+                'duration': session['duration'],
+                'interval_ms': interval_ms,
+                'started_at': session['started_at'],
+                'running': session['running'],
+                'samples': self.samples,
+                'distinct_stacks': len(self.stacks),
+                'dropped_stacks': self.dropped_stacks,
+                'routes': routes,
+            }
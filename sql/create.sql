@@ -60,6 +60,22 @@ CREATE TABLE borrow (
         ON UPDATE CASCADE
 ) ENGINE=InnoDB;
 
+-- 事件日志（outbox）：写操作在同一事务中追加事件，下游按序号增量消费
+CREATE TABLE event_outbox (
+    seq BIGINT PRIMARY KEY AUTO_INCREMENT,
+    event_type VARCHAR(30) NOT NULL,
+    entity_id INT NOT NULL,
+    payload JSON,
+    create_time DATETIME(3) DEFAULT CURRENT_TIMESTAMP(3)
+) ENGINE=InnoDB;
+
+CREATE TABLE outbox_checkpoint (
+    consumer VARCHAR(50) PRIMARY KEY,
+    last_seq BIGINT NOT NULL DEFAULT 0,
+    pending JSON,
+    update_time DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB;
+
 -- 创建统计视图（为复杂查询提供便利）
 CREATE OR REPLACE VIEW book_borrow_stats AS
 SELECT 
@@ -0,0 +1,169 @@
+"""准入控制压测：统计报表风暴下借还书是否仍然可用
+
+用 app.py 中相同的并发等级配置搭一个本地 Flask 服务，统计路由模拟耗时 GROUP BY，
+借书路由模拟短事务，两者共享一个有限大小的“连接池”。先测借书基线延迟，再在大量并发
+统计请求的同时持续借书，检查：
+    借书请求全部成功，p95 延迟没有明显劣化
+    超出统计等级容量的请求收到 503 + Retry-After
+    同时执行的统计请求数不超过该等级的并发上限
+
+用法：python tools/admission_storm.py [--analytics 60] [--clients 8] [--no-admission]
+--no-admission 关闭准入控制作对比，此时借书请求会被统计请求挤占连接池。检查失败时退出码为 1。
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from flask import Flask, jsonify
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionClass, AdmissionController  # noqa: E402
+from app import admission as app_admission  # noqa: E402
+
+DB_POOL_SIZE = 10         # 模拟的数据库连接数
+ANALYTICS_SECONDS = 1.5   # 模拟统计查询耗时
+CIRCULATION_SECONDS = 0.02
+
+
+def build_app(use_admission):
+    app = Flask(__name__)
+    pool = threading.BoundedSemaphore(DB_POOL_SIZE)
+    running = {'analytics': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def query(seconds):
+        with pool:
+            time.sleep(seconds)
+
+    @app.route('/api/statistics/reader_activity')
+    def reader_activity():
+        with lock:
+            running['analytics'] += 1
+            running['peak'] = max(running['peak'], running['analytics'])
+        try:
+            query(ANALYTICS_SECONDS)
+        finally:
+            with lock:
+                running['analytics'] -= 1
+        return jsonify({'success': True})
+
+    @app.route('/api/borrow_book', methods=['POST'])
+    def borrow_book():
+        query(CIRCULATION_SECONDS)
+        return jsonify({'success': True})
+
+    if use_admission:
+        # 复制 app.py 的等级配置，统计数据互不影响
+        classes = [
+            AdmissionClass(cls.name, cls.max_concurrent, cls.max_queue, cls.queue_timeout,
+                           cls.query_timeout, cls.retry_after)
+            for cls in app_admission.classes.values()
+        ]
+        AdmissionController(classes, app_admission.route_classes).init_app(app)
+    return app, running
+
+
+def call(url, method='GET'):
+    """返回 (状态码, Retry-After, 耗时秒)"""
+    req = urllib.request.Request(url, data=b'{}' if method == 'POST' else None, method=method,
+                                 headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            resp.read()
+            return resp.status, resp.headers.get('Retry-After'), time.perf_counter() - start
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get('Retry-After'), time.perf_counter() - start
+
+
+def circulation_load(base, clients, stop, results):
+    def worker():
+        while not stop.is_set():
+            results.append(call(base + '/api/borrow_book', 'POST'))
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='统计报表风暴下的准入控制压测')
+    parser.add_argument('--analytics', type=int, default=60, help='并发统计请求数')
+    parser.add_argument('--clients', type=int, default=8, help='并发借书客户端数')
+    parser.add_argument('--no-admission', action='store_true', help='关闭准入控制作对比')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app, running = build_app(not args.no_admission)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:%d' % server.server_port
+
+    # 基线：只有借书请求
+    stop = threading.Event()
+    baseline = []
+    threads = circulation_load(base, args.clients, stop, baseline)
+    time.sleep(2)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # 风暴：统计请求集中涌入，同时持续借书
+    stop = threading.Event()
+    storm = []
+    threads = circulation_load(base, args.clients, stop, storm)
+    analytics = []
+    storm_threads = [
+        threading.Thread(target=lambda: analytics.append(call(base + '/api/statistics/reader_activity')))
+        for _ in range(args.analytics)
+    ]
+    for thread in storm_threads:
+        thread.start()
+    for thread in storm_threads:
+        thread.join()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    base_p95 = percentile([elapsed for _, _, elapsed in baseline], 0.95)
+    storm_p95 = percentile([elapsed for _, _, elapsed in storm], 0.95)
+    circulation_failed = sum(1 for status, _, _ in storm if status != 200)
+    admitted = sum(1 for status, _, _ in analytics if status == 200)
+    shed = [retry_after for status, retry_after, _ in analytics if status == 503]
+    print('借书基线   ：%d 次，p95 %.1f ms' % (len(baseline), base_p95 * 1000))
+    print('风暴中借书 ：%d 次，失败 %d 次，p95 %.1f ms' % (len(storm), circulation_failed, storm_p95 * 1000))
+    print('统计请求   ：%d 次，执行 %d 次，503 %d 次（Retry-After=%s），最大同时执行 %d'
+          % (len(analytics), admitted, len(shed), sorted(set(shed)), running['peak']))
+
+    analytics_class = app_admission.classes['analytics']
+    checks = [
+        ('借书请求全部成功', circulation_failed == 0),
+        ('借书 p95 不超过基线 3 倍（且至少留 50ms 余量）', storm_p95 <= max(base_p95 * 3, base_p95 + 0.05)),
+        ('超出容量的统计请求返回 503', len(shed) > 0),
+        ('503 响应带 Retry-After', all(value == str(analytics_class.retry_after) for value in shed)),
+        ('统计并发不超过上限', running['peak'] <= analytics_class.max_concurrent),
+    ]
+    ok = True
+    for name, passed in checks:
+        print('%s %s' % ('[通过]' if passed else '[失败]', name))
+        ok = ok and passed
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""分馆分片合并验证脚本
+
+在本地 MySQL 上用 sql/create.sql 建两个分馆库（east / west），通过 Flask 测试客户端带 ?branch=
+写入读者、书籍和借还记录，再检查不指定分馆时搜索与统计的合并结果。同一组检查分别在
+在线查询（经后台报表任务）、列式分析快照、内存派生状态三条路径上各执行一次。
+最后在相同并发下分别压测只查一个分馆和同时查两个分馆的搜索，比较每秒请求数：
+分片并行查询时，两个分馆的吞吐应接近单个分馆，而不是减半。
+
+需要本地 MySQL，连接参数默认取 app.DB_CONFIG，可用命令行参数覆盖。
+运行时会删除并重建 library_harness_east / library_harness_west 两个库，结束后默认删除。
+
+用法：python tools/shard_harness.py [--host localhost] [--user root] [--password ...] [--keep]
+                                    [--clients 8] [--seconds 3]
+检查失败时退出码为 1。
+"""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import mysql.connector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as library  # noqa: E402
+
+SCHEMAS = {'east': 'library_harness_east', 'west': 'library_harness_west'}
+# 两个分馆的吞吐不低于单个分馆的比例；串行逐个查询分片时约为 0.5
+MIN_THROUGHPUT_RATIO = 0.7
+
+# 各分馆的分类创建顺序不同，同名分类的分类ID也不同
+BOOKS = {
+    'east': [('三体', '刘慈欣', '科幻', 3), ('活着', '余华', '文学', 2)],
+    'west': [('围城', '钱钟书', '文学', 1), ('三体', '刘慈欣', '科幻', 1)],
+}
+READERS = {'east': ['张三', '李四'], 'west': ['王五']}
+# (读者, 书名)
+BORROWS = {
+    'east': [('张三', '三体'), ('李四', '三体'), ('张三', '活着')],
+    'west': [('王五', '三体'), ('王五', '围城')],
+}
+RETURNS = {'east': [('张三', '活着')], 'west': []}
+
+
+def create_schema(server, database):
+    """按 sql/create.sql 建库（把其中的库名替换为 database）"""
+    with open(os.path.join(ROOT, 'sql', 'create.sql'), encoding='utf-8') as f:
+        script = f.read().replace('library_db', database)
+
+    conn = mysql.connector.connect(**server)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DROP DATABASE IF EXISTS %s" % database)
+        for statement in re.split(r';\s*\n', script):
+            if re.sub(r'--[^\n]*', '', statement).strip():
+                cursor.execute(statement)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def drop_schema(server, database):
+    conn = mysql.connector.connect(**server)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DROP DATABASE IF EXISTS %s" % database)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+class Harness:
+    def __init__(self, client):
+        self.client = client
+        self.failures = []
+
+    def call(self, method, url, branch=None, json=None):
+        if branch:
+            url += ('&' if '?' in url else '?') + 'branch=' + branch
+        response = self.client.open(url, method=method, json=json)
+        data = response.get_json()
+        if not data or not data.get('success'):
+            raise RuntimeError('%s %s 失败：%s' % (method, url, data))
+        return data
+
+    def report(self, url, branch=None):
+        """耗时统计接口：返回后台任务时轮询到完成（与前端 callReportAPI 一致）"""
+        data = self.call('GET', url, branch)
+        deadline = time.monotonic() + 60
+        while data.get('pending') and time.monotonic() < deadline:
+            time.sleep(0.2)
+            job = self.call('GET', '/api/reports/jobs/' + data['job']['job_id'])['data']
+            if job['status'] == 'done':
+                return {'success': True, 'data': job['result']}
+            if job['status'] not in ('queued', 'running'):
+                raise RuntimeError('报表任务未完成：%s' % job)
+        if data.get('pending'):
+            raise RuntimeError('报表任务超时：%s' % url)
+        return data
+
+    def check(self, name, passed, detail=''):
+        print('%s %s%s' % ('[通过]' if passed else '[失败]', name, '' if passed else '：%s' % (detail,)))
+        if not passed:
+            self.failures.append(name)
+
+    def load_data(self):
+        for branch in SCHEMAS:
+            for name in READERS[branch]:
+                self.call('POST', '/api/register_reader', branch, {'name': name, 'gender': '男', 'phone': '1'})
+            for book_name, author, category_name, count in BOOKS[branch]:
+                self.call('POST', '/api/add_book', branch, {
+                    'book_name': book_name, 'author': author, 'publisher': '出版社',
+                    'category_name': category_name, 'total_count': count,
+                })
+
+            readers = {row['name']: row['reader_id'] for row in self.call('GET', '/api/list_readers', branch)['data']}
+            books = {row['book_name']: row['book_id'] for row in self.call('GET', '/api/list_books', branch)['data']}
+            for reader, book in BORROWS[branch]:
+                self.call('POST', '/api/borrow_book', branch, {'reader_id': readers[reader], 'book_id': books[book]})
+
+            records = self.call('GET', '/api/borrow_records', branch)['data']
+            for reader, book in RETURNS[branch]:
+                borrow_id = next(row['borrow_id'] for row in records
+                                 if row['reader_name'] == reader and row['book_name'] == book)
+                self.call('POST', '/api/return_book', branch, {'borrow_id': borrow_id})
+
+    def check_search(self, label):
+        books = self.call('GET', '/api/search_books?keyword=三体')['data']
+        self.check('%s：搜索合并两个分馆' % label,
+                   sorted(book['branch'] for book in books) == ['east', 'west'], books)
+
+    def check_statistics(self, label, expect_snapshot):
+        popularity = self.call('GET', '/api/statistics/book_popularity')
+        top = popularity['data'][0]
+        self.check('%s：借阅排行第一为 east 的三体' % label,
+                   (top['branch'], top['book_name'], top['borrow_count']) == ('east', '三体', 2), top)
+        self.check('%s：借阅排行总借阅次数' % label,
+                   sum(book['borrow_count'] for book in popularity['data']) == 5, popularity['data'])
+        used_snapshot = all(value is not None for value in popularity['snapshot_at'].values())
+        self.check('%s：snapshot_at 与数据来源一致' % label, used_snapshot == expect_snapshot,
+                   popularity['snapshot_at'])
+
+        categories = {row['category_name']: row
+                      for row in self.report('/api/statistics/category_distribution')['data']}
+        scifi, literature = categories.get('科幻', {}), categories.get('文学', {})
+        self.check('%s：科幻分类合并' % label,
+                   (scifi.get('book_count'), scifi.get('total_copies'), scifi.get('total_borrow')) == (2, 4, 3),
+                   scifi)
+        self.check('%s：文学分类合并' % label,
+                   (literature.get('book_count'), literature.get('total_copies'), literature.get('total_borrow'))
+                   == (2, 3, 2), literature)
+        self.check('%s：合并结果按分馆返回分类ID' % label,
+                   scifi.get('category_ids') == {'east': 1, 'west': 2} and 'category_id' not in scifi, scifi)
+
+        single = self.report('/api/statistics/category_distribution', 'west')['data']
+        self.check('%s：单分馆分类统计' % label,
+                   {row['category_name']: row['category_ids'] for row in single}
+                   == {'文学': {'west': 1}, '科幻': {'west': 2}}, single)
+
+        readers = {row['name']: row for row in self.report('/api/statistics/reader_activity')['data']}
+        self.check('%s：读者活跃度合并' % label,
+                   {name: (row['branch'], row['total_borrow'], row['current_borrow']) for name, row in readers.items()}
+                   == {'张三': ('east', 2, 1), '李四': ('east', 1, 1), '王五': ('west', 2, 2)}, readers)
+
+    def check_sql_only(self):
+        trend = self.report('/api/statistics/borrow_trend')['data']
+        today = [row for row in trend['daily'] if row['borrow_count']]
+        self.check('借阅趋势按日合并',
+                   [(row['borrow_count'], row['unique_readers']) for row in today] == [(5, 3)], trend['daily'])
+
+        overview = self.call('GET', '/api/statistics/library_overview')['data']
+        self.check('总览合并',
+                   (overview['books']['total_books'], overview['books']['total_copies'],
+                    overview['readers']['total_readers'], overview['borrows']['total_borrows'],
+                    overview['borrows']['current_borrows'], overview['borrows']['returned_borrows'])
+                   == (4, 7, 3, 5, 4, 1), overview)
+        self.check('热门作者跨分馆合并',
+                   overview['top_authors'][0] == {'author': '刘慈欣', 'book_count': 2}, overview['top_authors'])
+
+    def throughput(self, branch, clients, seconds):
+        """clients 个并发客户端持续搜索 seconds 秒，返回 (每秒请求数, 失败次数)"""
+        url = '/api/search_books?keyword=三体' + ('&branch=' + branch if branch else '')
+        counts = {'done': 0, 'failed': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + seconds
+
+        def worker():
+            client = library.app.test_client()  # 测试客户端不能跨线程共用
+            while time.monotonic() < deadline:
+                data = client.get(url).get_json()
+                with lock:
+                    counts['done' if data and data.get('success') else 'failed'] += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(clients)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return counts['done'] / (time.monotonic() - start), counts['failed']
+
+    def check_throughput(self, clients, seconds):
+        single, single_failed = self.throughput('east', clients, seconds)
+        both, both_failed = self.throughput(None, clients, seconds)
+        print('吞吐：单个分馆 %.1f 次/秒，两个分馆 %.1f 次/秒（%d 个并发客户端，各 %d 秒）'
+              % (single, both, clients, seconds))
+        self.check('吞吐测试请求全部成功', single_failed == 0 and both_failed == 0, (single_failed, both_failed))
+        self.check('两个分馆吞吐不低于单个分馆的 %d%%' % (MIN_THROUGHPUT_RATIO * 100),
+                   both >= single * MIN_THROUGHPUT_RATIO, '%.1f / %.1f' % (both, single))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分馆分片合并验证')
+    parser.add_argument('--host', default=library.DB_CONFIG['host'])
+    parser.add_argument('--user', default=library.DB_CONFIG['user'])
+    parser.add_argument('--password', default=library.DB_CONFIG['password'])
+    parser.add_argument('--keep', action='store_true', help='结束后保留两个分馆库')
+    parser.add_argument('--clients', type=int, default=8, help='吞吐测试的并发客户端数')
+    parser.add_argument('--seconds', type=int, default=3, help='吞吐测试每轮持续秒数')
+    args = parser.parse_args()
+    server = {'host': args.host, 'user': args.user, 'password': args.password}
+
+    for database in SCHEMAS.values():
+        create_schema(server, database)
+
+    # 只登记两个测试分馆；快照与热启动文件写到临时目录
+    tmp_dir = tempfile.mkdtemp(prefix='shard_harness_')
+    library.ANALYTICS_SNAPSHOT_DIR = os.path.join(tmp_dir, 'analytics_snapshot')
+    library.CATALOG_STATE_PATH = os.path.join(tmp_dir, 'catalog_state.%s.snapshot')
+    library.report_jobs.result_dir = os.path.join(tmp_dir, 'report_results')
+    for registry in (library.BRANCH_SHARDS, library.analytics_engines, library.snapshot_exporters,
+                     library.warm_states, library.shard_pools):
+        registry.clear()
+    for branch, database in SCHEMAS.items():
+        library.register_branch(branch, dict(server, database=database))
+    library.DEFAULT_BRANCH = 'east'
+    # 由脚本控制后台快照刷新和内存状态加载的时机
+    library.app.before_request_funcs[None].remove(library.start_warm_state)
+
+    harness = Harness(library.app.test_client())
+    try:
+        harness.load_data()
+
+        harness.check_search('在线查询')
+        harness.check_statistics('在线查询', expect_snapshot=False)
+        harness.check_sql_only()
+        # 内存派生状态启动前搜索走在线查询，每个请求都要查询分片
+        harness.check_throughput(args.clients, args.seconds)
+
+        for exporter in library.snapshot_exporters.values():
+            exporter.refresh(full=True)
+        harness.check_statistics('列式快照', expect_snapshot=True)
+
+        for manager in library.warm_states.values():
+            manager.ensure_started()
+        deadline = time.monotonic() + 30
+        while not library.warm_states_ready(list(SCHEMAS)) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        harness.check('内存派生状态就绪', library.warm_states_ready(list(SCHEMAS)))
+        harness.check_search('内存派生状态')
+        for manager in library.warm_states.values():
+            manager.stop()
+    finally:
+        if not args.keep:
+            for database in SCHEMAS.values():
+                drop_schema(server, database)
+
+    print('共 %d 项失败' % len(harness.failures) if harness.failures else '全部通过')
+    return 1 if harness.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())